@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Compare the form decoder against the previous implementation
+
+Bodies of 1 KB to 64 KB are built both from plain values, which take
+the no-decoding fast path, and from values that need '+' and %XX
+decoding.
+"""
+
+import os
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mortimer.util
+
+SIZES = (1024, 8192, 65536)
+NUMBER = 50
+
+def old_parse_post_vars(data):
+    """ The parser this benchmark is measured against """
+    post = {}
+    spc = lambda x: x.replace('+', ' ')
+    for p in data.split('&'):
+        try:
+            vals = p.split('=')
+            vals = [spc(v) for v in vals]
+            vals = [urllib.unquote(v) for v in vals]
+            (k, v) = vals
+            if not k in post:
+                post[k] = v
+            elif isinstance(post[k], list):
+                post[k].append(v)
+            else:
+                post[k] = [post[k], v]
+        except ValueError:
+            pass
+    return post
+
+def build_body(size, encoded):
+    pairs = []
+    total = 0
+    i = 0
+    while total < size:
+        if encoded:
+            value = urllib.quote_plus('value %d & more: 100%%' %(i,))
+        else:
+            value = 'value_%d_plain_text' %(i,)
+        pair = 'field%d=%s' %(i % 50, value)
+        pairs.append(pair)
+        total += len(pair) + 1
+        i += 1
+    return '&'.join(pairs)
+
+def time_parse(func, body):
+    timer = timeit.Timer(lambda: func(body))
+    return min(timer.repeat(3, NUMBER)) / NUMBER * 1e6
+
+def main():
+    print('%6s %-8s %10s %10s %8s' %('size', 'body', 'old us', 'new us', 'speedup'))
+    for size in SIZES:
+        for encoded in (False, True):
+            body = build_body(size, encoded)
+            old = time_parse(old_parse_post_vars, body)
+            new = time_parse(mortimer.util.parse_post_vars, body)
+            kind = encoded and 'encoded' or 'plain'
+            print('%6d %-8s %10.1f %10.1f %7.2fx' %(size, kind, old, new, old / new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Measure the cold-start import time of mortimer's modules
+
+Each module is imported in a fresh interpreter, several times, and the
+best time is reported along with the number of modules it loaded and
+which of the heavy optional dependencies came with it. On interpreters
+supporting -X importtime, the slowest imports of mortimer.web are
+listed as well.
+"""
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+MODULES = ('mortimer.web', 'mortimer.util', 'mortimer.session', 'mortimer.view',
+           'mortimer.cache', 'mortimer.compress', 'mortimer.stats')
+HEAVY = ('jinja2', 'httplib', 'socket', 'sqlite3', 'email.utils', 'tempfile',
+         'mimetypes', 'mortimer.session', 'mortimer.view')
+REPEAT = 10
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+heavy = [m for m in %r if m in sys.modules]
+print('%%f %%d %%s' %% (elapsed, len(sys.modules), ','.join(heavy)))
+"""
+
+def run(code, *options):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.check_output((sys.executable,) + options + ('-c', code),
+                                   env=env, stderr=subprocess.STDOUT)
+
+def import_time(module):
+    best = None
+    for i in range(REPEAT):
+        (elapsed, count, heavy) = (run(SCRIPT %(module, HEAVY)).decode().split(' ') + [''])[:3]
+        if best is None or float(elapsed) < best[0]:
+            best = (float(elapsed), int(count), heavy.strip())
+    return best
+
+def importtime_report(module, top=15):
+    """ Return the slowest imports from -X importtime, or None """
+    if sys.version_info < (3, 7):
+        return None
+    output = run('import ' + module, '-X', 'importtime').decode()
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        (own, cumulative, name) = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(own), name.strip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+def main():
+    print('%-20s %10s %8s  %s' %('module', 'ms', 'modules', 'heavy dependencies loaded'))
+    for module in MODULES:
+        (elapsed, count, heavy) = import_time(module)
+        print('%-20s %10.1f %8d  %s' %(module, elapsed * 1000, count, heavy or '-'))
+    rows = importtime_report('mortimer.web')
+    if rows is not None:
+        print('')
+        print('%12s %12s  %s' %('cumulative us', 'self us', 'module'))
+        for (cumulative, own, name) in rows:
+            print('%12d %12d  %s' %(cumulative, own, name))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Compare the scan and combined route dispatchers
+
+For each route table size, time a lookup that hits the first route,
+a lookup that hits the last route, and a lookup that misses (a 404).
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mortimer.web
+
+SIZES = (10, 100, 1000)
+NUMBER = 2000
+
+def build_router(dispatch, size):
+    router = mortimer.web.Router(dispatch=dispatch)
+    routes = [(r'^/section%d/item/(\d+)/?$' %(i,), i) for i in range(size)]
+    router.add_route_list(routes)
+    ## build the dispatcher before timing
+    router.find_route('/')
+    return router
+
+def time_lookup(router, uri):
+    timer = timeit.Timer(lambda: router.find_route(uri))
+    return min(timer.repeat(3, NUMBER)) / NUMBER * 1e6
+
+def main():
+    print('%6s %-8s %10s %10s %10s' %('routes', 'dispatch', 'first us', 'last us', 'miss us'))
+    for size in SIZES:
+        uris = ('/section0/item/1', '/section%d/item/1' %(size - 1,), '/missing')
+        for dispatch in mortimer.web.Router.DISPATCH_MODES:
+            router = build_router(dispatch, size)
+            times = [time_lookup(router, uri) for uri in uris]
+            print('%6d %-8s %10.2f %10.2f %10.2f' %((size, dispatch) + tuple(times)))
+
+if __name__ == '__main__':
+    main()
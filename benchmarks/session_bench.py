@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Compare session serializers on encode time, decode time and size
+
+'pickle-session' is the previous format, which pickled the whole
+Session object with the default protocol.
+"""
+
+import os
+import sys
+import timeit
+import cPickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mortimer.session
+
+NUMBER = 500
+
+class LegacySerializer(mortimer.session.BaseSerializer):
+    def dumps(self, data):
+        return cPickle.dumps(data)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+SERIALIZERS = (
+    ('pickle-session', LegacySerializer()),
+    ('pickle', mortimer.session.PickleSerializer()),
+    ('json', mortimer.session.JSONSerializer(compress_threshold=None)),
+    ('json-zlib', mortimer.session.JSONSerializer(compress_threshold=1024)),
+)
+
+def build_session(items):
+    session = mortimer.session.Session(session_id='benchmark')
+    session['user_id'] = 12345
+    session['username'] = 'someone@example.com'
+    for i in range(items):
+        session['item%d' %(i,)] = {
+            'id': i,
+            'name': 'product name %d' %(i,),
+            'tags': ['a', 'b', 'c'],
+            'price': 19.99,
+        }
+    return session
+
+def main():
+    print('%6s %-15s %10s %10s %8s' %('items', 'serializer', 'encode us', 'decode us', 'bytes'))
+    for items in (0, 10, 100, 1000):
+        session = build_session(items)
+        for (name, serializer) in SERIALIZERS:
+            data = serializer.dumps(session)
+            encode = min(timeit.Timer(lambda: serializer.dumps(session)).repeat(3, NUMBER))
+            decode = min(timeit.Timer(lambda: serializer.loads(data)).repeat(3, NUMBER))
+            print('%6d %-15s %10.1f %10.1f %8d' %(items, name,
+                  encode / NUMBER * 1e6, decode / NUMBER * 1e6, len(data)))
+
+if __name__ == '__main__':
+    main()
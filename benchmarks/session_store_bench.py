@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Load test the persistent session stores
+
+Saves and loads SESSIONS sessions through each store, one at a time,
+in batches, and from several threads at once, and reports sessions
+per second.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mortimer.session
+
+SESSIONS = 20000
+THREADS = 4
+
+def session_data(serializer, i):
+    return serializer.dumps({'user_id': i, 'username': 'user%d@example.com' %(i,),
+                             'cart': range(10)})
+
+def rate(count, func):
+    start = time.time()
+    func()
+    return count / (time.time() - start)
+
+def threaded(store, ids, action):
+    def run(chunk):
+        for session_id in chunk:
+            action(session_id)
+        close = getattr(store, 'close', None)
+        if close is not None:
+            close()
+    threads = [threading.Thread(target=run, args=(ids[i::THREADS],)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def bench(name, store, items):
+    ids = [session_id for (session_id, data) in items]
+    results = [
+        ('save', rate(len(items), lambda: [store.save(session_id, data) for (session_id, data) in items])),
+        ('load', rate(len(ids), lambda: [store.load(session_id) for session_id in ids])),
+        ('load %d threads' %(THREADS,), rate(len(ids), lambda: threaded(store, ids, store.load))),
+    ]
+    if hasattr(store, 'save_many'):
+        results.append(('save_many', rate(len(items), lambda: store.save_many(items))))
+    if hasattr(store, 'load_many'):
+        results.append(('load_many', rate(len(ids), lambda: store.load_many(ids))))
+    for (action, per_sec) in results:
+        print('%-12s %-16s %12.0f' %(name, action, per_sec))
+
+def main():
+    serializer = mortimer.session.PickleSerializer()
+    items = [('session%d' %(i,), session_data(serializer, i)) for i in range(SESSIONS)]
+    print('%d sessions' %(SESSIONS,))
+    print('%-12s %-16s %12s' %('store', 'action', 'sessions/s'))
+    path = tempfile.mkdtemp()
+    try:
+        bench('file', mortimer.session.FileStore(os.path.join(path, 'files'), shard_depth=1), items)
+        bench('sqlite', mortimer.session.SQLiteStore(os.path.join(path, 'sessions.db'), ttl=3600), items)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
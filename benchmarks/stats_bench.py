@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Measure the overhead of request statistics
+
+Runs the same requests through an application without stats and with
+stats enabled, and reports the time per request of each.
+"""
+
+import os
+import sys
+import timeit
+import StringIO
+import wsgiref.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mortimer.web
+import mortimer.stats
+
+NUMBER = 20000
+
+class HelloHandler(mortimer.web.RequestHandler):
+    def get(self):
+        return 'Hello, World'
+
+class FormHandler(mortimer.web.RequestHandler):
+    def post(self):
+        return self.post_args.get('name', '')
+
+def make_application(stats):
+    application = mortimer.web.WebApplication(stats=stats)
+    application.router.add_route((r'^/$', HelloHandler))
+    application.router.add_route((r'^/form$', FormHandler))
+    return application
+
+def make_request(application, path, body=None):
+    env = {}
+    wsgiref.util.setup_testing_defaults(env)
+    env['PATH_INFO'] = path
+    if body is not None:
+        env['REQUEST_METHOD'] = 'POST'
+        env['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        env['CONTENT_LENGTH'] = str(len(body))
+    def start_response(status, headers):
+        pass
+    def request():
+        request_env = dict(env)
+        if body is not None:
+            request_env['wsgi.input'] = StringIO.StringIO(body)
+        for chunk in application(request_env, start_response):
+            pass
+    return request
+
+def main():
+    print('%-8s %12s %12s %10s' %('request', 'off us', 'on us', 'overhead'))
+    for (name, path, body) in (('hello', '/', None), ('form', '/form', 'name=value&a=1&b=2')):
+        times = []
+        for stats in (None, mortimer.stats.Stats()):
+            request = make_request(make_application(stats), path, body)
+            times.append(min(timeit.Timer(request).repeat(3, NUMBER)) / NUMBER * 1e6)
+        print('%-8s %12.2f %12.2f %9.1f%%' %(name, times[0], times[1],
+              (times[1] - times[0]) / times[0] * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" End-to-end benchmarks of the WSGI request path
+
+Each scenario calls a WebApplication directly with a synthetic WSGI
+environment, and reports requests per second, the memory allocated by
+a single request, the objects left behind per request and the peak
+memory of the scenario.
+
+    python benchmarks/suite.py --save baseline.json
+    python benchmarks/suite.py --compare baseline.json
+
+Comparing against a saved baseline flags every scenario whose request
+rate dropped by more than the threshold, and exits with a status of 1
+if there were any.
+
+Every scenario runs in a subprocess of its own, so the peak memory
+reported by getrusage is that of the scenario alone. Allocations are
+measured with tracemalloc, and reported as n/a on interpreters that do
+not have it, such as Python 2. The objects left behind are counted on
+every interpreter, from the growth of gc.get_objects() over a batch of
+requests, and show caches filling up or leaks.
+"""
+
+import os
+import re
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import StringIO
+import subprocess
+import wsgiref.util
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mortimer.web
+import mortimer.session
+
+## the template scenario needs jinja2. mortimer.view imports it lazily,
+## so importing mortimer.view succeeds either way
+import mortimer.view as view
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+class HelloHandler(mortimer.web.RequestHandler):
+    def get(self, *args):
+        return 'Hello, World'
+
+class FormHandler(mortimer.web.RequestHandler):
+    def post(self):
+        return str(len(self.post_args))
+
+class UploadHandler(mortimer.web.RequestHandler):
+    def post(self):
+        return str(sum(upload['size'] for upload in self.files.values()))
+
+class SessionHandler(mortimer.web.RequestHandler):
+    def get(self):
+        session = self.session
+        session['views'] = session.get('views', 0) + 1
+        return str(session['views'])
+
+class TemplateHandler(mortimer.web.RequestHandler):
+    view = None
+
+    def get(self):
+        return self.view.render('page.html', title='Benchmark', items=range(50))
+
+class MemoryStore(mortimer.session.BaseStore):
+    """ Session store keeping sessions in a dict """
+    def __init__(self, **kwargs):
+        super(MemoryStore, self).__init__(**kwargs)
+        self.sessions = {}
+
+    def save(self, session_id, data):
+        self.sessions[session_id] = data
+
+    def load(self, session_id):
+        return self.sessions[session_id]
+
+    def delete(self, session_id):
+        self.sessions.pop(session_id, None)
+
+TEMPLATE = """<html><head><title>{{ title }}</title></head><body>
+<ul>{% for item in items %}<li class="{{ loop.cycle('odd', 'even') }}">{{ item }}</li>{% endfor %}</ul>
+</body></html>"""
+
+
+class NullStream(object):
+    """ wsgi.errors stream discarding the tracebacks of 404s """
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Scenario(object):
+    """ A request to send repeatedly to an application
+
+    Attributes:
+        name        -- name the results are saved under
+        application -- WebApplication to call
+        env         -- WSGI environment of the request
+        body        -- request body, or None
+    """
+    def __init__(self, name, application, path='/', method='GET', body=None,
+                 content_type=None, headers=None):
+        self.name = name
+        self.application = application
+        self.body = body
+        self.env = {}
+        wsgiref.util.setup_testing_defaults(self.env)
+        self.env['PATH_INFO'] = path
+        self.env['REQUEST_METHOD'] = method
+        self.env['wsgi.errors'] = NullStream()
+        if body is not None:
+            self.env['CONTENT_TYPE'] = content_type
+            self.env['CONTENT_LENGTH'] = str(len(body))
+        for (name, val) in (headers or {}).items():
+            self.env['HTTP_' + name.upper().replace('-', '_')] = val
+
+    def start_response(self, status, headers, exc_info=None):
+        pass
+
+    def request(self):
+        env = self.env.copy()
+        if self.body is not None:
+            env['wsgi.input'] = StringIO.StringIO(self.body)
+        body = self.application(env, self.start_response)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def make_application(routes, dispatch='scan'):
+    application = mortimer.web.WebApplication()
+    application.router = mortimer.web.Router(dispatch=dispatch)
+    application.router.add_route_list(routes)
+    return application
+
+def route_table(size):
+    routes = [(r'^/section%d/(\d+)$' %(i,), HelloHandler) for i in range(size)]
+    return routes + [(r'^/$', HelloHandler)]
+
+def urlencoded(fields, size):
+    return '&'.join('field%d=%s' %(i, 'x' * size) for i in range(fields))
+
+def multipart(size):
+    return '\r\n'.join([
+        '--boundary',
+        'Content-Disposition: form-data; name="title"',
+        '',
+        'upload',
+        '--boundary',
+        'Content-Disposition: form-data; name="file"; filename="data.bin"',
+        'Content-Type: application/octet-stream',
+        '',
+        'x' * size,
+        '--boundary--',
+        '',
+    ])
+
+def build_scenarios(template_path):
+    hello = make_application([(r'^/$', HelloHandler)])
+    small_table = make_application(route_table(50))
+    large_scan = make_application(route_table(1000))
+    large_combined = make_application(route_table(1000), dispatch='combined')
+    forms = make_application([(r'^/form$', FormHandler), (r'^/upload$', UploadHandler)])
+    sessions = make_application([(r'^/$', SessionHandler)])
+    sessions.session_store = MemoryStore()
+    sessions.session_store.save('benchmark', mortimer.session.Session.serializer.dumps({'views': 0}))
+
+    scenarios = [
+        Scenario('hello', hello),
+        Scenario('404-flood', small_table, path='/missing/page'),
+        Scenario('routes-1000-scan', large_scan),
+        Scenario('routes-1000-combined', large_combined),
+        Scenario('routes-1000-404', large_combined, path='/missing/page'),
+    ]
+    for (name, fields, size) in (('small', 5, 10), ('medium', 50, 100), ('large', 500, 1000)):
+        scenarios.append(Scenario('post-urlencoded-' + name, forms, path='/form', method='POST',
+                                  body=urlencoded(fields, size),
+                                  content_type='application/x-www-form-urlencoded'))
+    for (name, size) in (('1k', 1024), ('64k', 64 * 1024), ('2m', 2 * 1024 * 1024)):
+        scenarios.append(Scenario('post-multipart-' + name, forms, path='/upload', method='POST',
+                                  body=multipart(size),
+                                  content_type='multipart/form-data; boundary=boundary'))
+    scenarios.append(Scenario('session', sessions, headers={'Cookie': 'session_id=benchmark'}))
+
+    if jinja2 is None:
+        return scenarios
+    with open(os.path.join(template_path, 'page.html'), 'w') as f:
+        f.write(TEMPLATE)
+    handler = type('TemplateHandler', (TemplateHandler,), {
+        'view': view.Jinja2View(template_path, auto_reload=False),
+    })
+    scenarios.append(Scenario('jinja2', make_application([(r'^/$', handler)])))
+    return scenarios
+
+
+def peak_memory():
+    """ Return the peak resident memory of the process in kilobytes """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## macOS reports bytes, everything else kilobytes
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def allocated(scenario):
+    """ Return the kilobytes allocated while handling one request """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        scenario.request()
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024.0
+
+def retained(scenario, count=100):
+    """ Return the number of objects left behind per request """
+    gc.collect()
+    before = len(gc.get_objects())
+    for i in range(count):
+        scenario.request()
+    gc.collect()
+    return (len(gc.get_objects()) - before) / float(count)
+
+def run_scenario(scenario, duration, repeat):
+    """ Return the results of a scenario as a dict """
+    ## warm up caches, and make sure the scenario works at all
+    scenario.request()
+    best = 0.0
+    for i in range(repeat):
+        gc.collect()
+        count = 0
+        batch = 10
+        start = time.time()
+        end = start + duration
+        while True:
+            for j in range(batch):
+                scenario.request()
+            count += batch
+            now = time.time()
+            if now >= end:
+                break
+            if now - start < duration / 10:
+                batch *= 2
+        best = max(best, count / (now - start))
+    return {
+        'rps': best,
+        'alloc_kb': allocated(scenario),
+        'objects': retained(scenario),
+        'peak_kb': peak_memory(),
+    }
+
+def run_subprocess(name, duration, repeat):
+    """ Run a scenario in a new interpreter, and return its results """
+    command = [sys.executable, os.path.abspath(__file__), '--scenario', name,
+               '--duration', str(duration), '--repeat', str(repeat)]
+    output = subprocess.check_output(command)
+    return json.loads(output.splitlines()[-1])
+
+def run_single(name, duration, repeat):
+    """ Run a scenario in this process, and print its results as JSON """
+    template_path = tempfile.mkdtemp()
+    try:
+        for scenario in build_scenarios(template_path):
+            if scenario.name == name:
+                break
+        else:
+            sys.stderr.write('unknown scenario: %s\n' %(name,))
+            return 2
+        result = run_scenario(scenario, duration, repeat)
+    finally:
+        shutil.rmtree(template_path)
+    print(json.dumps(result))
+    return 0
+
+def format_value(value, fmt):
+    if value is None:
+        return 'n/a'
+    return fmt %(value,)
+
+def compare(results, baseline, threshold):
+    """ Return the names of the scenarios that got slower than threshold """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print('%-24s no baseline' %(name,))
+            continue
+        change = (result['rps'] - base['rps']) / base['rps'] * 100
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-24s %12.0f %12.0f %+8.1f%%%s' %(name, base['rps'], result['rps'], change, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the end-to-end request benchmarks.')
+    parser.add_argument('-d', '--duration', type=float, default=1.0,
+                        help='seconds to run each scenario for, per repeat')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of runs per scenario, the best is kept')
+    parser.add_argument('-f', '--filter', default=None,
+                        help='only run scenarios whose name matches this regular expression')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a baseline')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage drop in requests/sec reported as a regression')
+    ## used by run_subprocess() to run a single scenario
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.scenario:
+        return run_single(args.scenario, args.duration, args.repeat)
+
+    template_path = tempfile.mkdtemp()
+    try:
+        names = [scenario.name for scenario in build_scenarios(template_path)]
+    finally:
+        shutil.rmtree(template_path)
+    if args.filter:
+        names = [name for name in names if re.search(args.filter, name)]
+    results = {}
+    print('%-24s %12s %10s %12s %12s %10s' %('scenario', 'requests/s', 'us/req', 'alloc kb/req',
+                                             'objects/req', 'peak kb'))
+    for name in names:
+        result = run_subprocess(name, args.duration, args.repeat)
+        results[name] = result
+        print('%-24s %12.0f %10.1f %12s %12.2f %10s' %(name, result['rps'], 1e6 / result['rps'],
+              format_value(result['alloc_kb'], '%.1f'), result['objects'],
+              format_value(result['peak_kb'], '%d')))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('')
+        print('%-24s %12s %12s %9s' %('scenario', 'baseline', 'current', 'change'))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('%d scenario(s) regressed by more than %.0f%%' %(len(regressions), args.threshold))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import threading
+import util
+
+class BaseCache(object):
+    """ Base response cache backend
+
+    The cache backend is responsible for storing cached responses.
+    Subclasses of this class are responsible for implementing the get,
+    set and delete functionality, and may store the responses anywhere,
+    such as in a cache shared between processes. Values are instances
+    of CachedResponse, which can be pickled.
+    """
+    def __init__(self, **kwargs):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+class MemoryCache(BaseCache):
+    """ Process-local response cache backend
+
+    Responses are kept in memory, in an LRU cache holding at most
+    max_entries responses. Entries are dropped once their ttl is up.
+    """
+    def __init__(self, max_entries=1000, **kwargs):
+        super(MemoryCache, self).__init__(**kwargs)
+        self.entries = util.LRUCache(max_entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (expires, value) = entry
+        if expires < time.time():
+            self.entries.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, (time.time() + ttl, value))
+
+    def delete(self, key):
+        self.entries.delete(key)
+
+
+class CachedResponse(object):
+    """ A complete response, as stored in the response cache
+
+    Attributes:
+        status  -- HTTP status line
+        headers -- list of (name, value) header tuples
+        body    -- response body
+        expires -- time after which the response is stale
+    """
+    def __init__(self, status, headers, body, expires=0):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+
+    def cacheable(self):
+        """ Only successful responses that set no cookies are cached """
+        if not self.status.startswith('200'):
+            return False
+        for (name, val) in self.headers:
+            if name.lower() == 'set-cookie':
+                return False
+        return True
+
+
+class ResponseCache(object):
+    """ Whole-response cache with single-flight recomputation
+
+    When a cached response expires, only one request recomputes it.
+    Concurrent requests for the same key are served the stale copy,
+    which is kept for grace seconds after it expires. If there is no
+    stale copy, they wait up to wait_timeout seconds for the first
+    request to finish.
+
+    Attributes:
+        backend         -- BaseCache storing the responses, a
+                           MemoryCache by default
+        grace           -- seconds to keep serving a stale response
+                           while it is being recomputed
+        wait_timeout    -- seconds to wait for another request to
+                           compute a missing response
+    """
+    def __init__(self, backend=None, grace=30, wait_timeout=10):
+        if backend is None:
+            backend = MemoryCache()
+        self.backend = backend
+        self.grace = grace
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def fetch(self, key, ttl, compute):
+        """ Return the cached response for key, computing it if needed
+
+        compute is called with no arguments and returns a
+        CachedResponse. The response is only stored if it is cacheable.
+        """
+        entry = self.backend.get(key)
+        if entry is not None and entry.expires > time.time():
+            return entry
+
+        with self.lock:
+            event = self.pending.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self.pending[key] = event
+
+        if not leader:
+            if entry is not None:
+                return entry
+            event.wait(self.wait_timeout)
+            entry = self.backend.get(key)
+            if entry is not None:
+                return entry
+            ## the response could not be cached, compute our own
+            return compute()
+
+        try:
+            response = compute()
+            if response.cacheable():
+                response.expires = time.time() + ttl
+                self.backend.set(key, response, ttl + self.grace)
+            return response
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+    def invalidate(self, key):
+        self.backend.delete(key)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+import zlib
+import itertools
+import hashlib
+import util
+
+## window bits for each content coding. gzip adds 16 to get a gzip
+## header and trailer, deflate is the zlib format as the spec requires
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+## response bodies that were returned as a list by WebApplication come
+## back wrapped in iter(), but are just as complete as a list
+LIST_ITERATOR = type(iter([]))
+
+## the coding suffix added to the ETags of compressed responses
+CODED_ETAG_PATTERNS = dict((coding, re.compile('-%s"' %(coding,))) for coding in WBITS)
+
+def coded_etag(etag, coding):
+    """ Return the ETag of a response compressed with a coding
+
+    The compressed response is a different representation, so it needs
+    a different ETag than the uncompressed one.
+    """
+    if not etag.endswith('"'):
+        return etag
+    return '%s-%s"' %(etag[:-1], coding)
+
+def chain_body(chunks, rest, body):
+    """ Yield chunks and then the rest of a body, closing the body """
+    try:
+        for chunk in chunks:
+            yield chunk
+        for chunk in rest:
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+class CompressionMiddleware(object):
+    """ WSGI middleware compressing responses with gzip or deflate
+
+    Wrap an application to compress its responses for clients that
+    accept it:
+
+        app = mortimer.compress.CompressionMiddleware(MyWebApplication())
+
+    Only textual content types are compressed. Responses that are smaller
+    than min_size, already have a Content-Encoding, are partial, or ask
+    for no-transform are sent unchanged.
+
+    Bodies that are fully built in memory are compressed in one go, and
+    the compressed bytes are kept in a bounded cache keyed on the hash
+    of the body, so a hot response is only compressed once. Streaming
+    bodies are compressed chunk by chunk as they are sent.
+
+    The ETag of a compressed response gets the coding as a suffix, so
+    it differs from the ETag of the uncompressed response. The suffix
+    is removed from the If-None-Match header before the request is
+    passed on, so the application can still answer with a 304.
+
+    Attributes:
+        application     -- WSGI application to wrap
+        min_size        -- smallest body in bytes worth compressing
+        level           -- zlib compression level
+        cache_size      -- number of compressed bodies to cache, 0 disables
+        max_cache_item  -- largest body in bytes to cache
+    """
+    COMPRESSIBLE_TYPES = (
+        'text/',
+        'application/json',
+        'application/javascript',
+        'application/x-javascript',
+        'application/xml',
+        'image/svg+xml',
+    )
+
+    def __init__(self, application, min_size=512, level=6, cache_size=256,
+                 max_cache_item=1024 * 1024):
+        self.application = application
+        self.min_size = min_size
+        self.level = level
+        self.max_cache_item = max_cache_item
+        self.cache = None
+        if cache_size:
+            self.cache = util.LRUCache(cache_size)
+
+    def choose_coding(self, env):
+        """ Pick the content coding to use for a request, if any """
+        if env.get('REQUEST_METHOD') == 'HEAD':
+            return None
+        accept = env.get('HTTP_ACCEPT_ENCODING')
+        if not accept:
+            return None
+        for coding in ('gzip', 'deflate'):
+            if util.accepts_encoding(accept, coding):
+                return coding
+        return None
+
+    def compressible(self, status, headers):
+        """ Check if a response can be compressed """
+        if not status.startswith('200') and not status.startswith('203'):
+            return False
+        ctype = ''
+        for (name, val) in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            elif name == 'cache-control' and 'no-transform' in val:
+                return False
+            elif name == 'content-length':
+                try:
+                    if int(val) < self.min_size:
+                        return False
+                except ValueError:
+                    return False
+            elif name == 'content-type':
+                ctype = val.split(';', 1)[0].strip().lower()
+        if ctype.endswith('+json') or ctype.endswith('+xml'):
+            return True
+        return ctype.startswith(self.COMPRESSIBLE_TYPES)
+
+    def compress(self, data, coding):
+        """ Compress a complete body, using the cache if possible """
+        key = None
+        if self.cache is not None and len(data) <= self.max_cache_item:
+            key = (coding, hashlib.md5(data).digest())
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                return compressed
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[coding])
+        compressed = compressor.compress(data) + compressor.flush()
+        if key is not None:
+            self.cache.set(key, compressed)
+        return compressed
+
+    def compress_iter(self, chunks, coding, body):
+        """ Compress the chunks of a streaming body as they are sent """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[coding])
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def __call__(self, env, start_response):
+        coding = self.choose_coding(env)
+        if coding is None:
+            return self.application(env, start_response)
+
+        ## the client may hold the compressed response, whose ETag the
+        ## application does not know about. Only the suffix of the coding
+        ## that would be sent is removed, a copy in another coding is no
+        ## use to the client
+        if_none_match = env.get('HTTP_IF_NONE_MATCH')
+        pattern = CODED_ETAG_PATTERNS[coding]
+        coded = if_none_match is not None and pattern.search(if_none_match) is not None
+        if coded:
+            env = dict(env)
+            env['HTTP_IF_NONE_MATCH'] = pattern.sub('"', if_none_match)
+
+        response = []
+        written = []
+        def capture(status, headers, *exc_info):
+            response[:] = [status, headers, exc_info]
+            return written.append
+        body = self.application(env, capture)
+        ## an application may call start_response once its body is first
+        ## iterated, so the body is read up to that point
+        rest = body
+        started = []
+        if not response:
+            rest = iter(body)
+            try:
+                for chunk in rest:
+                    started.append(chunk)
+                    if response:
+                        break
+                else:
+                    raise RuntimeError('start_response was not called')
+            except:
+                if hasattr(body, 'close'):
+                    body.close()
+                raise
+        (status, headers, exc_info) = response
+
+        if coded and status.startswith('304'):
+            headers = [(name, coded_etag(val, coding) if name.lower() == 'etag' else val)
+                       for (name, val) in headers]
+
+        if not self.compressible(status, headers):
+            start_response(status, headers, *exc_info)
+            if written or started:
+                return chain_body(written + started, rest, body)
+            return body
+
+        if written or isinstance(body, (list, tuple, LIST_ITERATOR)):
+            try:
+                data = ''.join(written) + ''.join(started) + ''.join(rest)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            if len(data) < self.min_size:
+                start_response(status, headers, *exc_info)
+                return [data]
+            data = self.compress(data, coding)
+            start_response(status, self.compressed_headers(headers, coding, len(data)), *exc_info)
+            return [data]
+
+        start_response(status, self.compressed_headers(headers, coding), *exc_info)
+        return self.compress_iter(itertools.chain(started, rest), coding, body)
+
+    def compressed_headers(self, headers, coding, length=None):
+        """ Return the headers for a compressed response
+
+        The Content-Length of the uncompressed body is replaced, the
+        coding is added to the ETag, and Accept-Encoding is added to the
+        Vary header.
+        """
+        result = []
+        vary = None
+        for (name, val) in headers:
+            lname = name.lower()
+            if lname == 'content-length':
+                continue
+            if lname == 'vary':
+                vary = val
+                continue
+            if lname == 'etag':
+                val = coded_etag(val, coding)
+            result.append((name, val))
+        if vary is None:
+            vary = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            vary += ', Accept-Encoding'
+        result.append(('Vary', vary))
+        result.append(('Content-Encoding', coding))
+        if length is not None:
+            result.append(('Content-Length', str(length)))
+        return result
@@ -13,10 +13,24 @@
 # under the License.
 
 import os
+import re
+import json
+import time
+import zlib
+import errno
+import atexit
 import random
+import tempfile
 import cPickle
 import hashlib
 import datetime
+import threading
+import weakref
+import traceback
+import util
+
+## only needed by SQLiteStore
+sqlite3 = util.LazyModule('sqlite3')
 
 class BaseStore(object):
     """ Base session storage class
@@ -38,6 +52,32 @@ class BaseStore(object):
     def delete(self, session_id):
         pass
 
+    def load_session(self, session_id, decode):
+        """ Load and decode the data of a session
+
+        Stores that can keep sessions decoded in memory can override
+        this to skip loading and decoding.
+        """
+        return decode(self.load(session_id))
+
+    def save_session(self, session_id, data, encode):
+        """ Encode and save the data of a session """
+        self.save(session_id, encode(data))
+
+    ## stores that can update single keys of a stored session set
+    ## this, and implement save_delta
+    supports_delta = False
+
+    def save_delta(self, session_id, updates, removed, serializer):
+        """ Update some keys of a stored session
+
+        Attributes:
+            updates     -- dict of keys that were set, and their values
+            removed     -- set of keys that were removed
+            serializer  -- serializer of the session
+        """
+        pass
+
 
 class DummyStore(BaseStore):
     """ Dummy session storage class
@@ -51,6 +91,20 @@ class DummyStore(BaseStore):
     pass
 
 
+## session ids come from cookies and are used as file names, so only
+## allow safe characters
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+## prefix of session file names, so the sweep never touches files that
+## do not belong to the store
+SESSION_PREFIX = 'session-'
+
+## prefix of the temporary files session data is written to
+TEMP_PREFIX = '.session-tmp-'
+
+## names of the shard directories
+SHARD_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+
 class FileStore(BaseStore):
     """ Store for saving session data to disk
 
@@ -59,32 +113,595 @@ class FileStore(BaseStore):
     configurable by passing in the path argument when initializing
     the file store.
 
-    The file name of each session will be the session id
+    The file name of each session will be the session id, prefixed with
+    'session-'. With shard_depth set, sessions are spread over nested
+    subdirectories named after the leading hex digits of the md5 of the
+    session id, such as path/3f/a1/session-<session id> for a depth of
+    2, which keeps the directories small.
+
+    Session data is written to a temporary file that is then renamed
+    over the session file, so concurrent readers never see a partial
+    write.
+
+    With ttl set, a session expires ttl seconds after it was last saved
+    or loaded, based on the file's mtime. Expired sessions are not
+    loaded, and sweep() removes them in bounded batches. sweep_every
+    starts a batch in a background thread after every sweep_every
+    saves, so requests never wait for it. Only files named like the
+    store's own session and temporary files are removed.
+
+    Attributes:
+        path        -- directory to store the sessions in
+        shard_depth -- number of subdirectory levels, 0 for none
+        ttl         -- seconds a session lives after it was last used,
+                       None for no expiry
+        sweep_every -- number of saves between sweeps, None to only
+                       sweep when sweep() is called
+        sweep_batch -- number of files a sweep examines
     """
-    def __init__(self, path='/tmp/', **kwargs):
+    def __init__(self, path='/tmp/', shard_depth=0, ttl=None, sweep_every=None,
+                 sweep_batch=100, **kwargs):
         super(FileStore, self).__init__(**kwargs)
         self.path = path
+        self.shard_depth = shard_depth
+        self.ttl = ttl
+        self.sweep_every = sweep_every
+        self.sweep_batch = sweep_batch
+        self.saves = 0
+        self.sweep_cursor = None
+        self.sweep_lock = threading.Lock()
+        self.sweeper = None
+
+    def filename(self, sess_id):
+        """ Return the file name of a session """
+        if not SESSION_ID_PATTERN.match(sess_id):
+            raise ValueError('invalid session id: %r' %(sess_id,))
+        if not self.shard_depth:
+            return os.path.join(self.path, SESSION_PREFIX + sess_id)
+        digest = hashlib.md5(sess_id).hexdigest()
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.path, *(shards + [SESSION_PREFIX + sess_id]))
 
     def save(self, sess_id, data):
         """ Save the session data to a file """
-        fname = os.path.join(self.path, sess_id)
-        with open(fname, 'w') as f:
-            f.write(data)
+        fname = self.filename(sess_id)
+        dirname = os.path.dirname(fname)
+        try:
+            (fd, tmpname) = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=dirname)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            (fd, tmpname) = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmpname, fname)
+        except:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        self.saves += 1
+        if self.sweep_every and self.saves % self.sweep_every == 0:
+            self.start_sweep()
 
     def load(self, sess_id):
         """ Load the session data from a file """
-        fname = os.path.join(self.path, sess_id)
-        with open(fname, 'r') as f:
+        fname = self.filename(sess_id)
+        with open(fname, 'rb') as f:
+            if self.ttl is not None:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                if age > self.ttl:
+                    self.delete(sess_id)
+                    raise IOError(errno.ENOENT, 'session expired', fname)
+                ## keep sessions in use alive, without touching
+                ## the file on every request
+                if age > self.ttl / 2.0:
+                    os.utime(fname, None)
             data = f.read()
         return data
 
     def delete(self, sess_id):
-        fname = os.path.join(self.path, sess_id)
         try:
-            os.remove(fname)
+            os.remove(self.filename(sess_id))
         except:
             pass
 
+    def session_files(self, path=None, depth=None):
+        """ Generate the file names of every stored session
+
+        Directories are listed one at a time, as the walk reaches them,
+        so a sweep batch only lists the directories it gets to.
+        """
+        if path is None:
+            (path, depth) = (self.path, self.shard_depth)
+        for name in self.listdir(path):
+            if depth:
+                if SHARD_PATTERN.match(name):
+                    for fname in self.session_files(os.path.join(path, name), depth - 1):
+                        yield fname
+            elif name.startswith(SESSION_PREFIX) or name.startswith(TEMP_PREFIX):
+                yield os.path.join(path, name)
+
+    def listdir(self, path):
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+
+    def start_sweep(self):
+        """ Run a sweep batch in a background thread, unless one is running """
+        sweeper = self.sweeper
+        if sweeper is not None and sweeper.is_alive():
+            return
+        self.sweeper = threading.Thread(target=self.run_sweep)
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+    def run_sweep(self):
+        try:
+            self.sweep()
+        except:
+            traceback.print_exc()
+
+    def sweep(self, limit=None):
+        """ Remove expired sessions, examining at most limit files
+
+        Each call continues where the previous one stopped, and starts
+        over once every session has been examined. Returns the number
+        of sessions removed.
+        """
+        if self.ttl is None:
+            return 0
+        if limit is None:
+            limit = self.sweep_batch
+        removed = 0
+        with self.sweep_lock:
+            if self.sweep_cursor is None:
+                self.sweep_cursor = self.session_files()
+            expires = time.time() - self.ttl
+            for i in range(limit):
+                try:
+                    fname = next(self.sweep_cursor)
+                except StopIteration:
+                    self.sweep_cursor = None
+                    break
+                try:
+                    if os.stat(fname).st_mtime < expires:
+                        os.remove(fname)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+class SQLiteStore(BaseStore):
+    """ Store for saving session data in an SQLite database
+
+    Sessions are kept in a single table of an SQLite database file,
+    which needs no outside service and is shared by every process
+    using the same path. Each thread keeps its own connection, which is
+    reused for every request the thread serves. Connections of threads
+    that have exited are closed when the next connection is opened. The
+    database runs in WAL mode, so readers are not blocked by a writer.
+
+    With ttl set, a session expires ttl seconds after it was last used.
+    Loading a session pushes its expiry back once more than half of the
+    ttl has passed, so active sessions are not written on every request.
+    Expired sessions are not loaded, and sweep() removes them with a
+    single indexed delete.
+
+    Delta writes are supported: the changed keys of a loaded session are
+    merged into the stored session in a single transaction, so requests
+    changing different keys of the same session at the same time do not
+    overwrite each other's changes.
+
+    Attributes:
+        path    -- database file, which is created if needed
+        ttl     -- seconds a session lives after it was last used, None
+                   for no expiry
+        timeout -- seconds to wait for another connection's lock
+    """
+    ## largest number of ids to look up with a single query, sqlite
+    ## limits the number of parameters of a statement
+    LOAD_CHUNK = 500
+
+    def __init__(self, path, ttl=None, timeout=30.0, **kwargs):
+        super(SQLiteStore, self).__init__(**kwargs)
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.local = threading.local()
+        ## (thread, pid, connection) of every open connection
+        self.connections = []
+        self.lock = threading.Lock()
+        with self.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                         '(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    def connection(self):
+        """ Return the connection of the current thread """
+        conn = getattr(self.local, 'conn', None)
+        ## connections must not be shared with a forked child
+        if conn is None or self.local.pid != os.getpid():
+            ## connections are only ever used by their own thread, but
+            ## are closed by another one once it has exited
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            with self.lock:
+                self.close_finished()
+                self.connections.append((weakref.ref(threading.current_thread()), os.getpid(), conn))
+        return conn
+
+    def close_finished(self):
+        """ Close the connections of threads that have exited
+
+        Connections inherited from a parent process are forgotten
+        without being closed, they belong to the parent.
+        """
+        pid = os.getpid()
+        connections = []
+        for (ref, conn_pid, conn) in self.connections:
+            if conn_pid != pid:
+                continue
+            thread = ref()
+            if thread is None or not thread.is_alive():
+                conn.close()
+            else:
+                connections.append((ref, conn_pid, conn))
+        self.connections = connections
+
+    def expires(self):
+        if self.ttl is None:
+            return None
+        return time.time() + self.ttl
+
+    def save(self, session_id, data):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+                         (session_id, sqlite3.Binary(data), self.expires()))
+
+    def save_many(self, items):
+        """ Save many (session id, data) pairs in one transaction """
+        expires = self.expires()
+        with self.connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+                             [(session_id, sqlite3.Binary(data), expires)
+                              for (session_id, data) in items])
+
+    def load(self, session_id):
+        conn = self.connection()
+        now = time.time()
+        row = conn.execute(
+            'SELECT data, expires FROM sessions WHERE id = ? AND (expires IS NULL OR expires > ?)',
+            (session_id, now)).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        (data, expires) = row
+        if expires is not None and self.ttl is not None and expires - now < self.ttl / 2.0:
+            with conn:
+                conn.execute('UPDATE sessions SET expires = ? WHERE id = ?',
+                             (now + self.ttl, session_id))
+        return str(data)
+
+    def load_many(self, session_ids):
+        """ Return a dict of the data of every session found """
+        session_ids = list(session_ids)
+        conn = self.connection()
+        now = time.time()
+        result = {}
+        for i in range(0, len(session_ids), self.LOAD_CHUNK):
+            chunk = session_ids[i:i + self.LOAD_CHUNK]
+            cursor = conn.execute(
+                'SELECT id, data FROM sessions WHERE id IN (%s) '
+                'AND (expires IS NULL OR expires > ?)' %(', '.join('?' * len(chunk)),),
+                chunk + [now])
+            for (session_id, data) in cursor:
+                result[session_id] = str(data)
+        return result
+
+    supports_delta = True
+
+    def save_delta(self, session_id, updates, removed, serializer):
+        """ Merge changed keys into the stored session """
+        with self.connection() as conn:
+            ## the no-op write takes the write lock before the read, so
+            ## no other connection can change the session in between
+            conn.execute('UPDATE sessions SET id = id WHERE id = ?', (session_id,))
+            row = conn.execute(
+                'SELECT data FROM sessions WHERE id = ? AND (expires IS NULL OR expires > ?)',
+                (session_id, time.time())).fetchone()
+            data = {}
+            if row is not None:
+                data = dict(serializer.loads(str(row[0])))
+            data.update(updates)
+            for key in removed:
+                data.pop(key, None)
+            conn.execute('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+                         (session_id, sqlite3.Binary(serializer.dumps(data)), self.expires()))
+
+    def delete(self, session_id):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    def sweep(self):
+        """ Remove every expired session, returning how many were removed """
+        with self.connection() as conn:
+            return conn.execute('DELETE FROM sessions WHERE expires <= ?',
+                                (time.time(),)).rowcount
+
+    def close(self):
+        """ Close the connection of the current thread """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+            with self.lock:
+                self.connections = [entry for entry in self.connections if entry[2] is not conn]
+
+
+## CachedStores to flush at exit. They are held weakly, so a store that
+## is no longer used can still be collected
+CACHED_STORES = weakref.WeakSet()
+
+def close_cached_stores():
+    for store in list(CACHED_STORES):
+        store.close()
+
+atexit.register(close_cached_stores)
+
+def run_flusher(ref, stopped, interval):
+    """ Flush a CachedStore every interval seconds until it is stopped
+
+    Only a weak reference to the store is held between flushes, so the
+    thread does not keep the store alive.
+    """
+    while not stopped.wait(interval):
+        store = ref()
+        if store is None:
+            return
+        try:
+            store.flush()
+        except:
+            traceback.print_exc()
+        del store
+
+
+class CachedStore(BaseStore):
+    """ Write-back caching wrapper around another store
+
+    Recently used sessions are kept decoded in an LRU cache, so loading
+    them needs no store access and no decoding. Saved sessions are
+    written to the wrapped store in batches by a background thread,
+    every flush_interval seconds, or as soon as max_dirty sessions are
+    waiting. Anything still waiting is written at interpreter exit, or
+    when close() is called. Sessions modified in the last flush_interval
+    seconds can therefore be lost if the process dies; a flush_interval
+    of 0 writes every session through to the store immediately.
+
+    The cache belongs to a single process. Other processes sharing the
+    wrapped store, such as the workers of a preforking server, do not
+    see its sessions until they are flushed, and can not clear it. A
+    cached session is therefore only used for max_age seconds, after
+    which it is loaded from the store again. This also lets the store
+    expire sessions, or push their expiry back when they are loaded.
+
+    The top-level items of a cached session are copied into each
+    Session, but nested values are shared between requests, so they
+    should be replaced rather than changed in place.
+
+    A session deleted while a flush is writing it is remembered until
+    the flush is done, and then deleted from the store again, so the
+    flush can not bring it back.
+
+    Attributes:
+        store           -- BaseStore to cache
+        max_entries     -- number of decoded sessions to keep in memory
+        flush_interval  -- seconds between flushes of modified sessions
+        max_dirty       -- number of waiting sessions that forces a flush
+        max_age         -- seconds a decoded session is used before it is
+                           loaded from the store again, flush_interval
+                           by default
+    """
+    def __init__(self, store, max_entries=10000, flush_interval=5.0, max_dirty=1000,
+                 max_age=None, **kwargs):
+        super(CachedStore, self).__init__(**kwargs)
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        if max_age is None:
+            max_age = flush_interval
+        self.max_age = max_age
+        ## (expiry time, decoded session) of recently used sessions
+        self.cache = util.LRUCache(max_entries)
+        ## serialized sessions waiting to be written, and those
+        ## currently being written by a flush
+        self.dirty = {}
+        self.flushing = {}
+        ## ids of sessions deleted while being flushed
+        self.deleted = set()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = None
+        self.flusher_pid = None
+        CACHED_STORES.add(self)
+
+    def load(self, session_id):
+        with self.lock:
+            if session_id in self.deleted:
+                raise KeyError(session_id)
+            data = self.dirty.get(session_id) or self.flushing.get(session_id)
+        if data is not None:
+            return data
+        return self.store.load(session_id)
+
+    def save(self, session_id, data):
+        self.cache.delete(session_id)
+        self.queue(session_id, data)
+
+    def delete(self, session_id):
+        self.cache.delete(session_id)
+        with self.lock:
+            self.dirty.pop(session_id, None)
+            if session_id in self.flushing:
+                self.deleted.add(session_id)
+        self.store.delete(session_id)
+
+    def load_session(self, session_id, decode):
+        entry = self.cache.get(session_id)
+        now = time.time()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            data = decode(self.load(session_id))
+        except KeyError:
+            self.cache.delete(session_id)
+            raise
+        self.cache.set(session_id, (now + self.max_age, data))
+        return data
+
+    def save_session(self, session_id, data, encode):
+        self.cache.set(session_id, (time.time() + self.max_age, dict(data)))
+        self.queue(session_id, encode(data))
+
+    def queue(self, session_id, data):
+        """ Queue serialized session data to be written to the store """
+        if not self.flush_interval:
+            self.store.save(session_id, data)
+            return
+        with self.lock:
+            self.dirty[session_id] = data
+            self.deleted.discard(session_id)
+            waiting = len(self.dirty)
+        self.start_flusher()
+        if waiting >= self.max_dirty:
+            self.flush()
+
+    def flush(self):
+        """ Write every waiting session to the store """
+        with self.flush_lock:
+            with self.lock:
+                self.flushing, self.dirty = self.dirty, {}
+            if not self.flushing:
+                return
+            try:
+                save_many = getattr(self.store, 'save_many', None)
+                if save_many is not None:
+                    save_many(self.flushing.items())
+                else:
+                    for (session_id, data) in self.flushing.items():
+                        self.store.save(session_id, data)
+            except:
+                ## put the sessions back, unless they were saved again
+                ## or deleted
+                with self.lock:
+                    for (session_id, data) in self.flushing.items():
+                        if session_id not in self.deleted:
+                            self.dirty.setdefault(session_id, data)
+                raise
+            finally:
+                with self.lock:
+                    deleted = self.deleted
+                    self.deleted = set()
+                    self.flushing = {}
+                ## the flush may have written sessions deleted meanwhile
+                for session_id in deleted:
+                    self.store.delete(session_id)
+
+    def start_flusher(self):
+        """ Start the background flusher, once per process """
+        pid = os.getpid()
+        if self.flusher_pid == pid:
+            return
+        with self.lock:
+            if self.flusher_pid == pid:
+                return
+            self.flusher_pid = pid
+            ## the thread stops once the store has been collected
+            stopped = self.stopped
+            ref = weakref.ref(self, lambda ref: stopped.set())
+            self.flusher = threading.Thread(target=run_flusher,
+                                            args=(ref, stopped, self.flush_interval))
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def close(self):
+        """ Stop the background flusher and write any waiting sessions """
+        self.stopped.set()
+        self.flush()
+
+
+class BaseSerializer(object):
+    """ Base session serializer class
+
+    The serializer turns the data items of a session into a string
+    for the session store, and back. Subclasses of this class are
+    responsible for implementing dumps and loads.
+    """
+    def dumps(self, data):
+        return ""
+
+    def loads(self, data):
+        return {}
+
+
+class PickleSerializer(BaseSerializer):
+    """ Serialize session data with cPickle
+
+    This is the default serializer. Any picklable value can be stored,
+    but loading a pickle can run arbitrary code, so the store must only
+    be writable by the application.
+    """
+    def dumps(self, data):
+        return cPickle.dumps(dict(data), cPickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class JSONSerializer(BaseSerializer):
+    """ Serialize session data as compact JSON
+
+    Only JSON types can be stored, and strings are loaded as unicode.
+    Payloads larger than compress_threshold bytes are compressed with
+    zlib. The first byte of the output tells the two formats apart.
+
+    Attributes:
+        compress_threshold  -- size in bytes above which payloads are
+                               compressed, None to never compress
+        level               -- zlib compression level
+    """
+    def __init__(self, compress_threshold=1024, level=6):
+        self.compress_threshold = compress_threshold
+        self.level = level
+
+    def dumps(self, data):
+        payload = json.dumps(data, separators=(',', ':'))
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            return 'z' + zlib.compress(payload, self.level)
+        return 'j' + payload
+
+    def loads(self, data):
+        if data[:1] == 'z':
+            return json.loads(zlib.decompress(data[1:]))
+        if data[:1] == 'j':
+            return json.loads(data[1:])
+        raise ValueError('unknown session data format')
+
+
+## values of these types can not be changed in place
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None), frozenset)
 
 class Session(dict):
     """ HTTP Session Implementation
@@ -95,26 +712,118 @@ class Session(dict):
     Optionally, a store implementation can be specified to instruct
     where the session data should be serialized to. By default
     session data will be serialized to the filesystem
+
+    Only the data items of the session are serialized, by the
+    session's serializer, which is a PickleSerializer by default.
+
+    Every dict method that modifies the session sets the dirty flag,
+    and the keys that were set or removed are kept in the changed and
+    removed sets. Stores that support delta writes are only sent those
+    keys. Assigning a value equal to the current one is not a change.
+
+    Changes made in place to nested values, such as appending to a list
+    stored in the session, can not be seen by the session. Either call
+    mark_changed() with the key, or enable track_nested, which compares
+    the serialized session with its state when loaded before saving.
     """
-    def __init__(self, data=None, session_id=None):
+    serializer = PickleSerializer()
+    track_nested = False
+
+    def __init__(self, data=None, session_id=None, serializer=None, track_nested=None):
         super(Session, self).__init__()
+        if serializer is not None:
+            self.serializer = serializer
+        if track_nested is not None:
+            self.track_nested = track_nested
         self.dirty = False
         self.deleted = False
+        self.loaded = False
+        self.digest = None
+        self.changed = set()
+        self.removed = set()
         self.session_id = session_id
         if data:
-            self.update(data)
+            dict.update(self, data)
         if not self.session_id:
             self.session_id = self.gen_session_id()
 
+    def mark_changed(self, key):
+        """ Flag a key as modified """
+        self.dirty = True
+        try:
+            self.changed.add(key)
+            self.removed.discard(key)
+        except AttributeError:
+            ## sessions pickled by older versions are unpickled by
+            ## setting their items before their attributes
+            pass
+
+    def mark_removed(self, key):
+        """ Flag a key as removed """
+        self.dirty = True
+        self.removed.add(key)
+        self.changed.discard(key)
+
     def __setitem__(self, key, value):
         """ Add item to the session
         When an item is added, the dirty flag will be set, which
         lets us know that the session must be written out to the
         SessionStore
         """
-        self.dirty = True
+        if key in self:
+            current = dict.__getitem__(self, key)
+            ## the same mutable object may have been changed in place,
+            ## but an equal object of the same type is no change at all.
+            ## 1 == True == 1.0 and 'a' == u'a', yet they serialize
+            ## differently
+            if current is value:
+                if isinstance(value, IMMUTABLE_TYPES):
+                    return
+            elif type(current) is type(value) and current == value:
+                return
+        self.mark_changed(key)
         dict.__setitem__(self, key, value)
 
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.mark_removed(key)
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.mark_removed(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        (key, value) = dict.popitem(self)
+        self.mark_removed(key)
+        return (key, value)
+
+    def clear(self):
+        for key in self.keys():
+            self.mark_removed(key)
+        dict.clear(self)
+
+    def snapshot(self):
+        """ Remember the serialized state of the session
+
+        Used by track_nested to tell if the session was changed in place
+        """
+        self.digest = hashlib.md5(self.serializer.dumps(self)).digest()
+
+    def changed_in_place(self):
+        if not self.track_nested or self.digest is None:
+            return False
+        return hashlib.md5(self.serializer.dumps(self)).digest() != self.digest
+
     def gen_session_id(self):
         """ Generate a random session id """
         s = hashlib.md5()
@@ -133,19 +842,42 @@ class Session(dict):
         The session data will only be serialized and written
         out to the SessionStore if any modifications have been
         made, as reported by the self.dirty flag
+
+        If the session was loaded from the store, and the store
+        supports delta writes, only the changed keys are written.
         """
-        if not self.dirty:
+        nested = not self.dirty and self.changed_in_place()
+        if not self.dirty and not nested:
             return
+        if self.loaded and not nested and getattr(store, 'supports_delta', False):
+            updates = dict((key, dict.__getitem__(self, key)) for key in self.changed)
+            store.save_delta(self.session_id, updates, self.removed, self.serializer)
+        else:
+            store.save_session(self.session_id, self, self.serializer.dumps)
         self.dirty = False
-        pdata = cPickle.dumps(self)
-        store.save(self.session_id, pdata)
+        self.loaded = True
+        self.changed = set()
+        self.removed = set()
+        if self.track_nested:
+            self.snapshot()
 
     @classmethod
-    def load(self, session_id, store=None):
-        """ Load a session from the SessionStore given a session id """
+    def load(self, session_id, store=None, serializer=None):
+        """ Load a session from the SessionStore given a session id
+
+        A missing or malformed session id starts a new session, with a
+        freshly generated id.
+        """
+        if serializer is None:
+            serializer = self.serializer
+        if not session_id or not SESSION_ID_PATTERN.match(session_id):
+            return Session(serializer=serializer)
         try:
-            serialized = store.load(session_id)
-            data = cPickle.loads(serialized)
-            return Session(data=data, session_id=session_id)
+            data = store.load_session(session_id, serializer.loads)
         except:
-            return Session(session_id=session_id)
+            return Session(session_id=session_id, serializer=serializer)
+        session = Session(data=data, session_id=session_id, serializer=serializer)
+        session.loaded = True
+        if session.track_nested:
+            session.snapshot()
+        return session
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys
+import time
+import bisect
+import threading
+import traceback
+
+## clock ids of CLOCK_MONOTONIC, which differ between systems
+CLOCK_MONOTONIC_IDS = {'linux': 1, 'darwin': 6, 'freebsd': 4}
+
+def monotonic_clock():
+    """ Return a function reading CLOCK_MONOTONIC through ctypes
+
+    Python 2 has no time.monotonic, so clock_gettime is called directly.
+    None is returned if the system or its C library does not have it.
+    """
+    ## sys.platform carries a version on some systems, such as 'linux2'
+    clock_id = CLOCK_MONOTONIC_IDS.get(sys.platform.rstrip('0123456789'))
+    if clock_id is None:
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        library = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+        clock_gettime = ctypes.CDLL(library).clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(clock_id, ctypes.byref(ts)):
+            raise OSError('clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    try:
+        monotonic()
+    except OSError:
+        return None
+    return monotonic
+
+## timings use a monotonic clock when there is one, so they are not
+## thrown off by changes to the system time: time.monotonic on Python 3,
+## CLOCK_MONOTONIC through ctypes on Python 2. Failing both, time.time
+## is used and monotonic is False
+clock = getattr(time, 'monotonic', None) or monotonic_clock()
+monotonic = clock is not None
+if clock is None:
+    clock = time.time
+
+## WSGI environment key holding the RequestTimer of a request
+TIMER_KEY = 'mortimer.timer'
+
+## phases a request is split into. 'other' is the time spent outside of
+## the named phases, and 'total' the whole request
+PHASES = ('route', 'body', 'parse', 'handler', 'session_load', 'session_save',
+          'render', 'other', 'total')
+
+## upper bounds in seconds of the histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+## route name of requests that did not match a route
+NO_ROUTE = '(none)'
+
+class Local(threading.local):
+    timer = None
+
+local = Local()
+
+def current_timer():
+    """ Return the RequestTimer of the request the thread is serving
+
+    None is returned if the request is not being timed.
+    """
+    return local.timer
+
+
+class Histogram(object):
+    """ Latency histogram with fixed buckets
+
+    Each value is counted in the first bucket whose upper bound it does
+    not exceed, values above the last bound go to an overflow bucket.
+
+    Attributes:
+        buckets -- upper bounds of the buckets, in increasing order
+        counts  -- number of values in each bucket, plus the overflow
+        count   -- number of values
+        total   -- sum of the values
+        max     -- largest value
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """ Return the upper bound of the bucket holding a percentile """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if index < len(self.buckets):
+            return min(self.buckets[index], self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.count and self.total / self.count,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': [[bound, count] for (bound, count)
+                        in zip(list(self.buckets) + [None], self.counts)],
+        }
+
+
+class RequestTimer(object):
+    """ Timings of the phases of a single request
+
+    Phases can nest, such as the session being loaded by the handler.
+    The time of a phase does not include the phases nested in it, so
+    the timings of a request add up to its total time.
+
+    Attributes:
+        route   -- name of the route that handled the request
+        status  -- HTTP status line of the response
+        timings -- dict of seconds spent in each phase
+    """
+    def __init__(self):
+        self.route = NO_ROUTE
+        self.status = None
+        self.timings = {}
+        self.stack = []
+
+    def begin(self, phase):
+        self.stack.append([phase, clock(), 0.0])
+
+    def end(self):
+        (phase, start, nested) = self.stack.pop()
+        elapsed = clock() - start
+        self.timings[phase] = self.timings.get(phase, 0.0) + elapsed - nested
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def call(self, phase, func, *args, **kwargs):
+        """ Call a function, timing it as a phase """
+        self.begin(phase)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.end()
+
+
+class Stats(object):
+    """ Per-route request latency statistics
+
+    Assign an instance to WebApplication.stats to time every request:
+
+        app.stats = mortimer.stats.Stats()
+
+    Each request is split into the phases listed in PHASES, and the
+    time of each phase is added to a histogram per route and phase.
+    Routes are named by RequestHandler.route_name(), the module and
+    name of their handler class by default. Time spent sending a
+    streaming response body is not included.
+
+    Hooks are called with the RequestTimer of every request once it
+    has been handled, which can be used to send the timings elsewhere.
+
+    Attributes:
+        buckets -- upper bounds of the histogram buckets
+        hooks   -- list of functions called with each RequestTimer
+    """
+    def __init__(self, buckets=BUCKETS, hooks=None):
+        self.buckets = buckets
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.statuses = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def measure(self, func, env, callback):
+        """ Call a WSGI application, timing the request """
+        timer = RequestTimer()
+        env[TIMER_KEY] = timer
+        def start_response(status, headers, *exc_info):
+            timer.status = status
+            return callback(status, headers, *exc_info)
+        previous = local.timer
+        local.timer = timer
+        start = clock()
+        try:
+            return func(env, start_response)
+        finally:
+            total = clock() - start
+            local.timer = previous
+            timer.timings['other'] = max(total - sum(timer.timings.values()), 0.0)
+            timer.timings['total'] = total
+            self.record(timer)
+            for hook in self.hooks:
+                try:
+                    hook(timer)
+                except:
+                    traceback.print_exc(file=env['wsgi.errors'])
+
+    def record(self, timer):
+        """ Add the timings of a request to the histograms """
+        with self.lock:
+            histograms = self.routes.get(timer.route)
+            if histograms is None:
+                histograms = self.routes[timer.route] = {}
+                self.statuses[timer.route] = {}
+            for (phase, elapsed) in timer.timings.iteritems():
+                histogram = histograms.get(phase)
+                if histogram is None:
+                    histogram = histograms[phase] = Histogram(self.buckets)
+                histogram.add(elapsed)
+            statuses = self.statuses[timer.route]
+            code = (timer.status or '').split(' ', 1)[0]
+            statuses[code] = statuses.get(code, 0) + 1
+
+    def snapshot(self):
+        """ Return the statistics as a dict, which can be sent as JSON """
+        with self.lock:
+            result = {}
+            for (route, histograms) in self.routes.iteritems():
+                result[route] = {
+                    'statuses': dict(self.statuses[route]),
+                    'phases': dict((phase, histogram.as_dict())
+                                   for (phase, histogram) in histograms.iteritems()),
+                }
+            return result
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+            self.statuses = {}
@@ -13,21 +13,84 @@
 # under the License.
 
 import re
-import urllib
-import httplib
+import threading
+import importlib
+import collections
+
+class LazyModule(object):
+    """ Proxy for a module that is only imported once it is used
+
+        jinja2 = util.LazyModule('jinja2')
+
+    The module is imported the first time one of its attributes is
+    looked up, so a module that is never used costs nothing at startup.
+    Attributes are cached on the proxy as they are looked up, which
+    makes later lookups as fast as on the module itself; modules that
+    rebind their globals after import should not be proxied.
+    """
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        module = self.__module
+        if module is None:
+            module = self.__module = importlib.import_module(self.__name)
+        value = getattr(module, attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        return '<lazy module %r>' %(self.__name,)
+
+## these pull in socket, mimetools and more, but are only needed by
+## some requests
+urllib = LazyModule('urllib')
+httplib = LazyModule('httplib')
+tempfile = LazyModule('tempfile')
+email_utils = LazyModule('email.utils')
+
+def unquote_plus(data):
+    """ Decode '+' to ' ' and unquote %XX escapes """
+    if '+' in data:
+        data = data.replace('+', ' ')
+    if '%' in data:
+        data = urllib.unquote(data)
+    return data
+
+def parse_form_vars(data):
+    """ Parse urlencoded form data into key-value pairs.
+
+    Pairs are separated by '&', and each key is separated from its
+    value by the first '='. A key without a value gets a blank value.
+    '+' is decoded to a space and %XX escapes are unquoted; if the data
+    contains neither, no decoding is done at all.
+
+    If there are multiple form items of the same name, a list will be
+    created containing all the values
+    """
+    args = {}
+    if not data:
+        return args
+    decode = '%' in data or '+' in data
+    for pair in data.split('&'):
+        if not pair:
+            continue
+        (k, sep, v) = pair.partition('=')
+        if decode:
+            k = unquote_plus(k)
+            v = unquote_plus(v)
+        if k not in args:
+            args[k] = v
+        elif isinstance(args[k], list):
+            args[k].append(v)
+        else:
+            args[k] = [args[k], v]
+    return args
 
 def parse_get_vars(data):
     """ Parse query string into key-value pairs. """
-    get = {}
-    if data is None or data == '':
-        return get
-    for p in data.split('&'):
-        try:
-            (k, v) = p.split('=')
-            get[k] = urllib.unquote(v)
-        except ValueError:
-            pass
-    return get
+    return parse_form_vars(data)
 
 def parse_post_vars(data):
     """ Parse post data into key-value pairs.
@@ -35,26 +98,7 @@ def parse_post_vars(data):
     If there are multiple form items of the same name, a list will be
     created containing all the values
     """
-    post = {}
-    spc = lambda x: x.replace('+', ' ')
-    for p in data.split('&'):
-        try:
-            vals = p.split('=')
-            ## convert '+' to ' '
-            vals = [spc(v) for v in vals]
-            ## unquote the data
-            vals = [urllib.unquote(v) for v in vals]
-
-            (k, v) = vals
-            if not k in post:
-                post[k] = v
-            elif isinstance(post[k], list):
-                post[k].append(v)
-            else:
-                post[k] = [post[k], v]
-        except ValueError:
-            pass
-    return post
+    return parse_form_vars(data)
 
 def parse_cookie_data(data):
     """ Parse cookie data into key-value pairs """
@@ -72,45 +116,205 @@ def parse_multipart(input, boundary):
     
     Parse mime-encoded multipart/form-data into a
     python dictionary. This function returns a tuple
-    consisting of post vars, and files.
+    consisting of post vars, and files. The contents
+    of each file are returned as a string.
     
     Attributes:
         input       -- Input data to be parsed
         boundary    -- Field boundary as returned in the content type
     """
-    files = {}
-    post_args = {}
+    ## the input is already in memory, so don't spool files to disk
+    parser = MultipartParser(boundary, spool_size=len(input))
+    parser.feed(input)
+    (post_args, files) = parser.close()
+    for info in files.values():
+        info['file'] = info['file'].read()
+    return (post_args, files)
+
+class FieldTooLarge(ValueError):
+    """ Raised by MultipartParser for a form field over max_field_size """
+    pass
+
+class MultipartParser(object):
+    """ Incremental multipart/form-data parser
+
+    The body is pushed to the parser in chunks of any size with feed(),
+    and close() returns a tuple of post vars and files. Boundaries are
+    found across chunk edges, so the body is never held in memory as a
+    whole. Form fields are kept in memory, and FieldTooLarge is raised
+    for a field larger than max_field_size bytes. Uploaded files are
+    written to a tempfile.SpooledTemporaryFile, which moves to disk once
+    it grows past spool_size bytes, or once the files kept in memory
+    add up to more than max_memory bytes. A file field sent more than
+    once keeps its last file, the earlier ones are closed.
+
+    Each file is returned as a dict:
+        {'filename': ..., 'content_type': ..., 'size': ..., 'file': ...}
+    where 'file' is a file-like object positioned at the start.
+
+    Attributes:
+        boundary        -- Field boundary as returned in the content type
+        spool_size      -- Size in bytes above which files are spooled to disk
+        max_header_size -- Maximum size of the headers of a single part
+        max_field_size  -- Maximum size of a form field that is not a file
+        max_memory      -- Maximum size in bytes of all the files kept in
+                           memory, spool_size by default
+    """
+    def __init__(self, boundary, spool_size=1024 * 1024, max_header_size=16384,
+                 max_field_size=1024 * 1024, max_memory=None):
+        self.delimiter = '\r\n--' + boundary
+        self.spool_size = spool_size
+        self.max_header_size = max_header_size
+        self.max_field_size = max_field_size
+        if max_memory is None:
+            max_memory = spool_size
+        self.max_memory = max_memory
+        self.field_size = 0
+        ## bytes of the finished files still in memory, the size of
+        ## each of them by field name, and the size above which the
+        ## current file moves to disk
+        self.memory = 0
+        self.in_memory = {}
+        self.part_limit = 0
+        ## the first boundary is not preceded by a line break, add
+        ## one so every boundary can be found with the same delimiter
+        self.buffer = '\r\n'
+        self.state = 'preamble'
+        self.part = None
+        self.post_args = {}
+        self.files = {}
+
+    def feed(self, data):
+        """ Parse the next chunk of the body """
+        self.buffer += data
+        while self.buffer and self.state != 'done':
+            if not getattr(self, 'read_' + self.state)():
+                break
 
-    ## skip the ending boundary (\r\n--<boundary>--)
-    skip = len('\r\n' + '--' + boundary + '--')
-    parts = input[:-skip].split('--' + boundary + '\r\n')
-    for part in parts:
-        end = part.find('\r\n\r\n')
+    def read_preamble(self):
+        idx = self.buffer.find(self.delimiter)
+        if idx == -1:
+            ## keep enough data to find a delimiter split across chunks
+            self.buffer = self.buffer[-len(self.delimiter):]
+            return False
+        self.buffer = self.buffer[idx + len(self.delimiter):]
+        self.state = 'delimiter'
+        return True
+
+    def read_delimiter(self):
+        """ Check if the delimiter ends the body, or starts a new part """
+        if len(self.buffer) < 2:
+            return False
+        if self.buffer.startswith('--'):
+            self.state = 'done'
+            self.buffer = ''
+            return False
+        ## skip any padding following the delimiter
+        end = self.buffer.find('\r\n')
         if end == -1:
-            ## if the part does not end in '\r\n\r\n', the
-            ## headers are messed up -- better skip this one
-            continue
-        headers = parse_headers(part[:end])
+            return False
+        self.buffer = self.buffer[end + 2:]
+        self.state = 'headers'
+        return True
+
+    def read_headers(self):
+        if self.buffer.startswith('\r\n'):
+            end, header = 2, ''
+        else:
+            end = self.buffer.find('\r\n\r\n')
+            if end == -1:
+                if len(self.buffer) > self.max_header_size:
+                    raise ValueError('multipart headers too large')
+                return False
+            header = self.buffer[:end]
+            end += 4
+        self.buffer = self.buffer[end:]
+        self.start_part(parse_headers(header))
+        self.state = 'body'
+        return True
+
+    def read_body(self):
+        idx = self.buffer.find(self.delimiter)
+        if idx == -1:
+            ## write out everything that can't be part of a delimiter
+            safe = len(self.buffer) - len(self.delimiter) + 1
+            if safe > 0:
+                self.write_part(self.buffer[:safe])
+                self.buffer = self.buffer[safe:]
+            return False
+        self.write_part(self.buffer[:idx])
+        self.buffer = self.buffer[idx + len(self.delimiter):]
+        self.finish_part()
+        self.state = 'delimiter'
+        return True
+
+    def start_part(self, headers):
         name_header = headers.get('Content-Disposition', '')
         if not name_header.startswith('form-data'):
             ## if the header doesn't begin with form-data
             ## it is an invalid multipart/form-data header
-            continue
+            self.part = None
+            return
         header_fields = parse_header_fields(name_header)
-        ## strip leading and trailing '\r\n'
-        data = part[end+4:-2]
         if 'filename' in header_fields:
-            name = header_fields.get('name')
-            files[name] = {
-                'filename': header_fields.get('filename'),
-                'content_type': headers.get('Content-Type', 'application/unknown'),
-                'size': len(data),
-                'file': data,
-            }
+            ## the file can only use what is left of max_memory
+            self.part_limit = min(self.spool_size, self.max_memory - self.memory)
+            target = tempfile.SpooledTemporaryFile(max_size=max(self.part_limit, 0))
+            if self.part_limit <= 0:
+                target.rollover()
         else:
-            name = header_fields.get('name')
-            post_args[name] = data
-    return (post_args, files)
+            target = []
+            self.field_size = 0
+        self.part = (header_fields, headers, target)
+
+    def write_part(self, data):
+        if self.part is None or not data:
+            return
+        target = self.part[2]
+        if isinstance(target, list):
+            self.field_size += len(data)
+            if self.field_size > self.max_field_size:
+                raise FieldTooLarge('multipart field too large')
+            target.append(data)
+        else:
+            target.write(data)
+
+    def finish_part(self):
+        if self.part is None:
+            return
+        (header_fields, headers, target) = self.part
+        self.part = None
+        name = header_fields.get('name')
+        if isinstance(target, list):
+            self.post_args[name] = ''.join(target)
+            return
+        size = target.tell()
+        target.seek(0)
+        previous = self.files.get(name)
+        if previous is not None:
+            self.memory -= self.in_memory.pop(name, 0)
+            previous['file'].close()
+        ## a file larger than its limit has already moved to disk
+        if size <= self.part_limit:
+            self.memory += size
+            self.in_memory[name] = size
+        self.files[name] = {
+            'filename': header_fields.get('filename'),
+            'content_type': headers.get('Content-Type', 'application/unknown'),
+            'size': size,
+            'file': target,
+        }
+
+    def close(self):
+        """ Finish parsing and return a tuple of post vars and files
+
+        A part that was cut off by the end of the body is dropped.
+        """
+        if self.part is not None and not isinstance(self.part[2], list):
+            self.part[2].close()
+        self.part = None
+        self.buffer = ''
+        return (self.post_args, self.files)
 
 def parse_header_fields(header):
     """ Parse header fields into a python dict
@@ -167,18 +371,396 @@ def parse_headers(header):
             last_header = token
     return headers
 
+## status lines of the status codes, so that sending a response does
+## not need to format one. The common codes are listed here, so most
+## applications never import httplib; the rest are filled in from
+## httplib.responses as they are first used
+STATUS_LINES = dict((code, '%d %s' %(code, message)) for (code, message) in (
+    (200, 'OK'),
+    (201, 'Created'),
+    (202, 'Accepted'),
+    (204, 'No Content'),
+    (206, 'Partial Content'),
+    (301, 'Moved Permanently'),
+    (302, 'Found'),
+    (303, 'See Other'),
+    (304, 'Not Modified'),
+    (307, 'Temporary Redirect'),
+    (400, 'Bad Request'),
+    (401, 'Unauthorized'),
+    (403, 'Forbidden'),
+    (404, 'Not Found'),
+    (405, 'Method Not Allowed'),
+    (409, 'Conflict'),
+    (413, 'Request Entity Too Large'),
+    (416, 'Requested Range Not Satisfiable'),
+    (500, 'Internal Server Error'),
+    (502, 'Bad Gateway'),
+    (503, 'Service Unavailable'),
+))
+
 def code_to_status(code):
     """ Convert HTTP code to response string
     The response are pulled from httplib.responses:
         200 => '200 OK'
-        404 => '404 NOT FOUND'
+        404 => '404 Not Found'
         ...
 
+    A status that is already a full status line, such as '302 Found',
+    is returned unchanged.
+
     Attributes:
         code -- HTTP status code
     """
     try:
-        return '%s %s' %(str(code), httplib.responses.get(code))
-    except:
-        raise
+        return STATUS_LINES[code]
+    except KeyError:
+        if isinstance(code, basestring) and ' ' in code:
+            return code
+        line = '%s %s' %(str(code), httplib.responses.get(code))
+        if code in httplib.responses:
+            STATUS_LINES[code] = line
+        return line
+
+class Headers(object):
+    """ Response header container
+
+    Headers are kept as a list of (name, value) tuples, in the order
+    they were added, as expected by WSGI. Adding a header replaces a
+    previous header of the same name in constant time. Header names are
+    compared case-insensitively. Set-Cookie headers are never replaced,
+    since there can be many of them in a response.
+
+    A Headers object can share a tuple of default headers with every
+    other response. The defaults are only copied once the headers are
+    modified, so a response that keeps the defaults copies nothing.
+
+    Attributes:
+        defaults    -- tuple of (name, value) tuples to start with
+    """
+    __slots__ = ('headers', 'index')
+
+    def __init__(self, defaults=()):
+        self.headers = defaults
+        ## maps lowercased header names to their position in the list,
+        ## None until the defaults have been copied
+        self.index = None
+
+    def __iter__(self):
+        return iter(self.headers)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def copy_on_write(self):
+        if self.index is not None:
+            return
+        self.headers = list(self.headers)
+        self.reindex()
+
+    def reindex(self):
+        self.index = {}
+        for (i, (name, val)) in enumerate(self.headers):
+            key = name.lower()
+            if key != 'set-cookie':
+                self.index[key] = i
+
+    def add(self, name, val):
+        """ Add a header, replacing a previous header of the same name """
+        self.copy_on_write()
+        key = name.lower()
+        if key == 'set-cookie':
+            self.headers.append((name, val))
+            return
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.headers)
+            self.headers.append((name, val))
+        else:
+            self.headers[i] = (name, val)
+
+    def append(self, header):
+        """ Append a (name, value) tuple without replacing anything """
+        self.copy_on_write()
+        self.headers.append(header)
+        key = header[0].lower()
+        if key != 'set-cookie':
+            self.index[key] = len(self.headers) - 1
+
+    def remove(self, name):
+        """ Remove every header with the given name """
+        key = name.lower()
+        self.headers = [h for h in self.headers if h[0].lower() != key]
+        self.reindex()
+
+    def get(self, name, default=None):
+        """ Return the value of a header, or default if it is not set """
+        key = name.lower()
+        if self.index is not None and key != 'set-cookie':
+            i = self.index.get(key)
+            if i is None:
+                return default
+            return self.headers[i][1]
+        for (hname, val) in reversed(self.headers):
+            if hname.lower() == key:
+                return val
+        return default
+
+    def items(self):
+        """ Return the headers as a list that can be passed to WSGI """
+        if self.index is None:
+            return list(self.headers)
+        return self.headers
+
+def http_date(timestamp):
+    """ Format a unix timestamp as an HTTP date """
+    return email_utils.formatdate(timestamp, usegmt=True)
+
+def parse_http_date(data):
+    """ Parse an HTTP date into a unix timestamp
+
+    None is returned if the date can not be parsed
+    """
+    parsed = email_utils.parsedate_tz(data)
+    if parsed is None:
+        return None
+    try:
+        return email_utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def etag_matches(header, etag):
+    """ Check if an If-None-Match header matches an entity tag
+
+    The header can hold a list of tags, or '*'. Tags are compared using
+    the weak comparison, so W/"x" matches "x".
+    """
+    if header.strip() == '*':
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def not_modified(env, etag, last_modified):
+    """ Check a request's validators against those of a response
+
+    Returns True if the client's copy of the response, as described by
+    If-None-Match or If-Modified-Since, matches the response's ETag or
+    Last-Modified header value. If-None-Match takes precedence, and
+    If-Modified-Since is only used when it is absent.
+    """
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag is not None and etag_matches(if_none_match, etag)
+    if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is None or last_modified is None:
+        return False
+    since = parse_http_date(if_modified_since)
+    modified = parse_http_date(last_modified)
+    return since is not None and modified is not None and modified <= since
+
+def accepts_encoding(header, coding):
+    """ Check if an Accept-Encoding header allows a content coding """
+    star = False
+    for item in header.split(','):
+        (name, sep, params) = item.partition(';')
+        name = name.strip().lower()
+        if name != coding and name != '*':
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name == coding:
+            return q > 0
+        star = q > 0
+    return star
+
+def parse_byte_range(header, size):
+    """ Parse a Range header holding a single byte range
+
+    Returns an inclusive (start, end) tuple, clamped to the size of the
+    content. If the range can not be satisfied, start will be past the
+    end of the content. None is returned if the header is malformed or
+    asks for several ranges, in which case the whole content should be
+    sent instead.
+
+    Attributes:
+        header  -- value of the Range header
+        size    -- size of the content in bytes
+    """
+    if not header.startswith('bytes='):
+        return None
+    spec = header[6:].strip()
+    if ',' in spec:
+        return None
+    (start, sep, end) = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        if not start.strip():
+            ## suffix range -- the last N bytes
+            suffix = int(end)
+            if suffix <= 0:
+                return (size, size - 1)
+            return (max(0, size - suffix), size - 1)
+        start = int(start)
+        if not end.strip():
+            return (start, size - 1)
+        end = int(end)
+    except ValueError:
+        return None
+    if start < 0 or end < start:
+        return None
+    return (start, min(end, size - 1))
+
+def iter_file_range(f, start, length, block_size=65536):
+    """ Read length bytes from a file starting at start, in blocks
+
+    The file is closed once the range has been read, or when the
+    iterator is closed.
+    """
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+## sentinel used to tell a cache miss apart from a cached None
+MISSING = object()
+
+class LRUCache(object):
+    """ Bounded least-recently-used cache
+
+    Once the cache holds capacity entries, adding a new entry evicts
+    the entry that was used least recently. Hits and misses are
+    counted, and all operations are safe to call from multiple threads.
+
+    Attributes:
+        capacity    -- maximum number of entries to keep
+    """
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """ Return the cached value for key, marking it as recently used """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Add or replace an entry, evicting the oldest if needed """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SegmentedLRUCache(LRUCache):
+    """ Scan resistant LRU cache
+
+    Entries are first added to a small probationary segment, and only
+    promoted to the protected segment when they are hit again. A flood
+    of one-off keys, such as a scanner requesting random URLs, only
+    churns the probationary segment and can not evict the hot entries
+    in the protected segment.
+
+    Attributes:
+        capacity        -- maximum number of entries to keep
+        protected_ratio -- share of the capacity reserved for entries
+                           that have been hit at least twice
+    """
+    def __init__(self, capacity=1000, protected_ratio=0.8):
+        super(SegmentedLRUCache, self).__init__(capacity)
+        self.protected_capacity = int(capacity * protected_ratio)
+        self.protected = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries) + len(self.protected)
+
+    def __contains__(self, key):
+        return key in self.protected or key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.protected.pop(key)
+            except KeyError:
+                try:
+                    value = self.entries.pop(key)
+                except KeyError:
+                    self.misses += 1
+                    return default
+                ## second hit -- promote to the protected segment,
+                ## demoting its oldest entry back to probation
+                if len(self.protected) >= self.protected_capacity and self.protected:
+                    (old_key, old_value) = self.protected.popitem(last=False)
+                    self.add_probation(old_key, old_value)
+            self.protected[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.protected:
+                self.protected[key] = value
+                return
+            self.entries.pop(key, None)
+            self.add_probation(key, value)
+
+    def add_probation(self, key, value):
+        self.entries[key] = value
+        while len(self.entries) + len(self.protected) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.protected.pop(key, None)
+            self.entries.pop(key, None)
 
+    def clear(self):
+        with self.lock:
+            self.protected.clear()
+            self.entries.clear()
@@ -12,31 +12,115 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import jinja2
+import util
+import stats
+
+## jinja2 is only imported once a view is set up
+jinja2 = util.LazyModule('jinja2')
 
 class Jinja2View(object):
     """ View controller using Jinja2
 
+    Compiled templates can be stored in a bytecode cache directory,
+    which is shared by every worker, so templates are only compiled
+    once. In production, auto_reload should be disabled; templates are
+    then looked up once and never checked for changes, and preload()
+    can be used to compile every template at startup.
+
     Attributes:
-        path -- file path to the jinja2 templates
+        path            -- file path to the jinja2 templates
+        bytecode_cache  -- directory to store compiled templates in,
+                           None to disable the bytecode cache
+        cache_size      -- number of templates jinja2 keeps in memory,
+                           -1 to keep all of them
+        auto_reload     -- check templates for changes when they are used
+        encoding        -- encoding of the rendered output
+        stream_buffer   -- number of template chunks buffered by
+                           render_stream() before they are sent
     """
-    def __init__(self, path=None):
+    def __init__(self, path=None, bytecode_cache=None, cache_size=400,
+                 auto_reload=True, encoding='utf-8', stream_buffer=64):
         self.path = path
+        self.bytecode_cache = bytecode_cache
+        self.cache_size = cache_size
+        self.auto_reload = auto_reload
+        self.encoding = encoding
+        self.stream_buffer = stream_buffer
         self.loader = None
         self.environment = None
+        self.templates = {}
 
         ## load the env is path is given
         if self.path is not None:
             self.setup_environment()
 
-    def set_view_path(path):
-        self.path = path;
+    def set_view_path(self, path):
+        self.path = path
         self.setup_environment()
 
     def setup_environment(self):
         self.loader = jinja2.FileSystemLoader(self.path)
-        self.environment = jinja2.Environment(loader=self.loader)
+        bytecode_cache = None
+        if self.bytecode_cache is not None:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(self.bytecode_cache)
+        self.environment = jinja2.Environment(
+            loader=self.loader,
+            bytecode_cache=bytecode_cache,
+            cache_size=self.cache_size,
+            auto_reload=self.auto_reload,
+        )
+        self.templates = {}
+
+    def get_template(self, template):
+        """ Return a compiled template
+
+        Without auto_reload, templates are kept in a dict once loaded,
+        which skips jinja2's cache lookup and up-to-date checks.
+        """
+        if self.auto_reload:
+            return self.environment.get_template(template)
+        try:
+            return self.templates[template]
+        except KeyError:
+            compiled = self.environment.get_template(template)
+            self.templates[template] = compiled
+            return compiled
+
+    def preload(self, extensions=None, filter_func=None):
+        """ Compile every template, returning the number loaded
+
+        The arguments are passed to jinja2's list_templates() to
+        select the templates to load.
+        """
+        names = self.environment.list_templates(extensions, filter_func)
+        for name in names:
+            self.get_template(name)
+        return len(names)
 
     def render(self, template, *args, **kwargs):
-        template = self.environment.get_template(template)
-        return template.render(*args, **kwargs).encode()
+        timer = stats.current_timer()
+        if timer is not None:
+            return timer.call('render', self.render_template, template, *args, **kwargs)
+        return self.render_template(template, *args, **kwargs)
+
+    def render_template(self, template, *args, **kwargs):
+        template = self.get_template(template)
+        return template.render(*args, **kwargs).encode(self.encoding)
+
+    def render_stream(self, template, *args, **kwargs):
+        """ Render a template as it is sent
+
+        Returns an iterator of encoded chunks, which can be returned
+        from a handler as a streaming response body. The template is
+        looked up and compiled right away, so a missing or broken
+        template is raised from the handler, before the response starts.
+        """
+        stream = self.get_template(template).stream(*args, **kwargs)
+        if self.stream_buffer > 1:
+            stream.enable_buffering(self.stream_buffer)
+        return self.encode_stream(stream)
+
+    def encode_stream(self, stream):
+        encoding = self.encoding
+        for chunk in stream:
+            yield chunk.encode(encoding)
@@ -12,12 +12,126 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
 import re
-import httplib
+import json
+import stat
+import time
+import hashlib
 import traceback
+import wsgiref.util
 import util
-import session
-import view
+import stats
+
+## subsystems that not every application uses are imported on first use,
+## so importing mortimer.web stays fast
+cache = util.LazyModule('mortimer.cache')
+session = util.LazyModule('mortimer.session')
+view = util.LazyModule('mortimer.view')
+mimetypes = util.LazyModule('mimetypes')
+
+## headers every response starts with, shared between all requests
+DEFAULT_HEADERS = (
+    ('Content-type', 'text/html; charset=UTF-8'),
+)
+
+## canned error responses, keyed on the status code and Allow header
+ERROR_RESPONSES = {}
+
+def error_response(status, allow=None):
+    """ Return a (status line, headers, body) tuple for an error page
+
+    The responses are built once and shared, callers must copy the
+    headers before handing them out.
+    """
+    key = (status, allow)
+    response = ERROR_RESPONSES.get(key)
+    if response is None:
+        line = util.code_to_status(status)
+        headers = [('Content-type', 'text/plain')]
+        if allow is not None:
+            headers.append(('Allow', allow))
+        headers.append(('Content-Length', str(len(line))))
+        response = ERROR_RESPONSES[key] = (line, tuple(headers), line)
+    return response
+
+class StreamingBody(object):
+    """ Response body wrapping an iterable returned by a handler
+
+    A streaming body runs after the handler has returned and the status
+    line has been sent, so the session is saved once the body has been
+    exhausted or closed rather than when the handler returns. Exceptions
+    raised while producing the body can no longer become an error page;
+    they are logged, the response is cut short and the session is not
+    saved. Callers that buffer the whole body before the response starts
+    use read() instead, which lets the exception through.
+
+    Attributes:
+        handler  -- RequestHandler that returned the body
+        iterable -- iterable returned by the handler
+    """
+    __slots__ = ('handler', 'iterable', 'iterator', 'finished')
+
+    def __init__(self, handler, iterable):
+        self.handler = handler
+        self.iterable = iterable
+        self.iterator = None
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            if self.iterator is None:
+                self.iterator = iter(self.iterable)
+            return self.iterator.next()
+        except StopIteration:
+            self.finish(True)
+            raise
+        except:
+            self.error()
+            raise StopIteration
+
+    def read(self):
+        """ Return the whole body as a string
+
+        Unlike iterating over the body, an exception raised while
+        producing it is passed on, and the session is not saved.
+        """
+        try:
+            body = ''.join(self.iterable)
+        except:
+            self.finished = True
+            raise
+        finally:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        self.finish(True)
+        return body
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        except:
+            self.error()
+        self.finish(True)
+
+    def error(self):
+        traceback.print_exc(file=self.handler.env['wsgi.errors'])
+        self.finish(False)
+
+    def finish(self, save):
+        if self.finished:
+            return
+        self.finished = True
+        ## the headers are gone, so the session cookie was set by execute()
+        if save and self.handler._session is not None:
+            try:
+                self.handler.store_session()
+            except:
+                traceback.print_exc(file=self.handler.env['wsgi.errors'])
 
 class RequestHandler(object):
     """ Base request handler class
@@ -28,61 +142,272 @@ class RequestHandler(object):
         def get(self, id):
             ...
 
+    The methods a handler implements are looked up once per class, and
+    requests for any other method are answered with a 405 listing the
+    allowed methods. HEAD requests are handled by get() when there is
+    no head(), with the body dropped, and OPTIONS requests are answered
+    with the allowed methods when there is no options().
+
+    Only the HTTP methods listed in http_methods are dispatched, so that
+    other methods of the class, such as redirect(), can never be called
+    by a request. Handlers of other HTTP methods extend the list:
+
+        class Collection(RequestHandler):
+            http_methods = RequestHandler.http_methods + ('PROPFIND', 'MKCOL')
+
+            def propfind(self):
+                ...
+
+    The request body is not read until it is used, through the
+    post_args, files, body or stream accessors. Bodies larger than
+    max_body_size are rejected with a 413 before any of it is read.
+    The query string, form data, files and cookies are each parsed at
+    most once per request.
+
+    Setting cache_ttl makes GET responses cacheable. They are stored by
+    the application's response cache, keyed on the path, the query
+    string and the request headers listed in cache_vary. Cached handlers
+    should not depend on anything else, such as the session; responses
+    that are not a 200, or that set a cookie, are never cached.
+
+    GET and HEAD requests are answered with a 304 Not Modified if the
+    response's ETag or Last-Modified header matches the request's
+    If-None-Match or If-Modified-Since. The validators can be set by the
+    handler method, computed from the body by setting auto_etag, or
+    returned by validators(), which is called before the handler method
+    so a 304 skips the handler's work entirely.
+
+    When the application keeps stats, the time spent in each phase of
+    the request is recorded by the stats.RequestTimer in timer.
+
+    Handlers can stream their response by returning a generator or other
+    iterable. The session is then saved once the whole body has been
+    sent, see StreamingBody. Its cookie has to be sent with the headers,
+    so a streaming handler that may start a new session should load
+    self.session before it returns the body. The body of a generator
+    function only runs once the response is being sent.
+
     Attributes:
         application -- Instance of WebApplication from which we were called
         env         -- WSGI environment dict
+        timer       -- stats.RequestTimer of the request, or None
     """
+    ## per-request state is kept in slots, so creating a handler is
+    ## cheap. Subclasses that add no attributes of their own can set
+    ## __slots__ = () to avoid an instance dict entirely
+    __slots__ = (
+        'application', 'env', 'timer', 'session_store', 'session_serializer',
+        'status', '_headers', '_session', '_body', '_body_read', '_get_args',
+        '_post_args', '_files', '_cookies', '_multipart',
+    )
+
+    ## maximum request body size in bytes. If None, the application's
+    ## max_body_size is used, if it has one
+    max_body_size = None
+    ## size of the chunks the request body is read in
+    body_chunk_size = 65536
+    ## uploaded files are spooled to disk once they, or all the files
+    ## of the request together, are larger than this many bytes
+    spool_size = 1024 * 1024
+    ## multipart form fields that are not files are kept in memory, and
+    ## rejected with a 413 if larger than this many bytes
+    max_field_size = 1024 * 1024
+    ## block size used to send file-like response bodies
+    file_block_size = 65536
+    ## if set, GET responses of this handler are cached by the
+    ## application's response cache for this many seconds
+    cache_ttl = None
+    ## request headers whose values are part of the cache key
+    cache_vary = ()
+    ## if set, an ETag is computed from the body of GET responses
+    auto_etag = False
+    ## name the requests of this handler are recorded under in the
+    ## stats. If None, route_name() uses the module and class name
+    stats_name = None
+    ## HTTP methods a handler can implement, in the order they are
+    ## listed in the Allow header. Requests for any other method are
+    ## answered with a 405, even if the class has a method of that name
+    http_methods = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS')
+    ## (class, methods, allow) tuple, built by dispatch_table(). It is
+    ## inherited by subclasses, which check the class to build their own
+    _dispatch_table = None
+
     def __init__(self, application, env):
         self.application = application
         self.env = env
+        self.timer = env.get(stats.TIMER_KEY)
+        ## the session settings are resolved once, by the application
+        self.session_store = application.session_store
+        self.session_serializer = application.session_serializer
         self._session = None
-        self.session_store = session.DummyStore()
         self.status = 200
-        self.headers = []
-        self.__raw_data = ''
+        ## created on first use, see the headers property
+        self._headers = None
+        self._body = None
+        self._body_read = False
+        ## parsed request data, filled in on first access
+        self._get_args = None
+        self._post_args = None
+        self._files = None
+        self._cookies = None
+        self._multipart = None
         self.init_request()
 
     def init_request(self):
-        """ Initialize the request """
-        self.headers = [
-            ('Content-type', 'text/html; charset=UTF-8')
-        ]
+        """ Initialize the request
+
+        Called at the end of __init__, subclasses can override this to
+        set up the request.
+        """
+        pass
+
+    @property
+    def headers(self):
+        """ Return the util.Headers of the response
+
+        The container is only created once the headers are used, a
+        response that keeps the default headers never creates one.
+        """
+        if self._headers is None:
+            self._headers = util.Headers(DEFAULT_HEADERS)
+        return self._headers
 
-        ## was a session store object specified?
+    @headers.setter
+    def headers(self, headers):
+        ## handlers have long assigned a plain list of tuples here
+        if not isinstance(headers, util.Headers):
+            headers = util.Headers(list(headers))
+        self._headers = headers
+
+    def response_headers(self):
+        """ Return the response headers as a list that can be passed to WSGI """
+        if self._headers is None:
+            return list(DEFAULT_HEADERS)
+        return self._headers.items()
+
+    @classmethod
+    def dispatch_table(cls):
+        """ Return the (methods, allow) dispatch table of the class
+
+        methods maps each HTTP method the class handles to the name of
+        the method handling it, and allow is the value of the Allow
+        header. The table is built on first use and stored on the class
+        itself, so methods added to a class after it has handled a
+        request are not seen.
+        """
+        table = cls._dispatch_table
+        if table is None or table[0] is not cls:
+            methods = {}
+            for method in cls.http_methods:
+                if callable(getattr(cls, method.lower(), None)):
+                    methods[method] = method.lower()
+            if 'GET' in methods and 'HEAD' not in methods:
+                methods['HEAD'] = 'get'
+            if 'OPTIONS' not in methods:
+                methods['OPTIONS'] = 'send_options'
+            allow = ', '.join([m for m in cls.http_methods if m in methods])
+            table = cls._dispatch_table = (cls, methods, allow)
+        return table[1:]
+
+    @classmethod
+    def route_name(cls):
+        """ Return the name the handler's requests are recorded under """
+        if cls.stats_name is not None:
+            return cls.stats_name
+        return '%s.%s' %(cls.__module__, cls.__name__)
+
+    @classmethod
+    def find_method(cls, method):
+        """ Return the name of the method handling an HTTP method, or None """
+        table = cls._dispatch_table
+        if table is None or table[0] is not cls:
+            return cls.dispatch_table()[0].get(method)
+        return table[1].get(method)
+
+    def send_options(self, *args, **kwargs):
+        """ Answer an OPTIONS request with the allowed methods """
+        self.add_header('Allow', self.dispatch_table()[1])
+        self.add_header('Content-Length', '0')
+        return ''
+
+    def timed(self, phase, func, *args):
+        """ Call a function, timing it as a phase of the request """
+        if self.timer is None:
+            return func(*args)
+        return self.timer.call(phase, func, *args)
+
+    @property
+    def content_length(self):
+        """ Return the length of the request body """
         try:
-            self.session_store = self.application.session_store
-        except AttributeError:
-            pass
+            return int(self.env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise HTTPError(status=400)
 
-        ## load in the data
-        content_length = 0
-        if self.env.get('CONTENT_LENGTH'):
-            content_length = int(self.env.get('CONTENT_LENGTH'))
-        self.__raw_data = self.env['wsgi.input'].read(content_length)
+    def check_body_size(self):
+        """ Raise a 413 HTTPError if the request body is too large """
+        limit = self.max_body_size
+        if limit is None:
+            limit = getattr(self.application, 'max_body_size', None)
+        if limit is not None and self.content_length > limit:
+            raise HTTPError(status=413)
+
+    @property
+    def body(self):
+        """ Return the raw request body, reading it on first access """
+        if self._body is None:
+            self._body = self.timed('body', ''.join, self.iter_body())
+        return self._body
+
+    @property
+    def stream(self):
+        """ Return an iterator over the request body in chunks """
+        return self.iter_body()
+
+    def iter_body(self, chunk_size=None):
+        """ Iterate over the request body in chunks
+
+        The body is read from wsgi.input as it is iterated, and is never
+        held in memory as a whole. wsgi.input can only be read once, so
+        after streaming the body it is no longer available through the
+        body property. If the body was already read through the body
+        property, the buffered copy is returned instead.
+        """
+        if self._body is not None:
+            return iter([self._body])
+        if self._body_read:
+            raise RuntimeError('the request body has already been read')
+        self.check_body_size()
+        self._body_read = True
+        return self.read_body_chunks(chunk_size or self.body_chunk_size)
+
+    def read_body_chunks(self, chunk_size):
+        """ Read at most CONTENT_LENGTH bytes from wsgi.input """
+        remaining = self.content_length
+        read = self.env['wsgi.input'].read
+        while remaining > 0:
+            chunk = read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
     def add_header(self, name, val):
         """ Add a header to our list of headers
 
-        Headers are defined in a list of tuples containing the header
-        name and header value:
+        Headers are kept in a util.Headers container, which holds a list
+        of tuples containing the header name and header value:
 
             [('Content-type', 'text/html'), ('Set-Cookie', 'cookie data')]
 
-        When adding a header to our list of headers, we check if the header
-        has been previously defined. If so,  we will first remove the
-        prevous header before adding the new header
+        When adding a header to our list of headers, any previously
+        defined header of the same name is replaced.
 
         There can be many set-cookie headers per request. We do not
         replace any previously-existing set-cookie headers when adding
         new set-cookie headers
         """
-        ## we can set multiple set-cookie headers
-        if name == 'Set-Cookie':
-            self.headers.append((name, val))
-        for header in self.headers:
-            if header[0] == name:
-                self.headers.remove(header)
-        self.headers.append((name, val))
+        self.headers.add(name, val)
 
     def set_content_type(self, ctype):
         """ Convenience method to set the content type """
@@ -105,58 +430,134 @@ class RequestHandler(object):
     def redirect(self, loc):
         """ Convenience method to send a redirect
 
-        We will redirect a user by returning a status of '302 FOUND'
+        We will redirect a user by returning a status of '302 Found'
         and setting the Location header in the response
         """
-        self.set_status('302 FOUND')
+        self.set_status(302)
         self.add_header('Location', loc)
         return ''
 
     @property
     def get_args(self):
         """ Return the parsed query string arguments of the request """
-        data = self.env['QUERY_STRING']
-        return util.parse_get_vars(data)
+        if self._get_args is None:
+            data = self.env.get('QUERY_STRING', '')
+            self._get_args = self.timed('parse', util.parse_get_vars, data)
+        return self._get_args
 
     @property
     def post_args(self):
         """ Return the parsed post arguments of the request"""
-        ## multipart/form-data
-        if self.env.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
-            content_type = self.env.get('CONTENT_TYPE', '')
-            boundary = content_type.split('boundary=', 1)[1]
-            post, files = util.parse_multipart(self.__raw_data, boundary)
-            return post
-        ## normal post submission
-        return util.parse_post_vars(self.__raw_data)
+        if self._post_args is None:
+            ## multipart/form-data
+            if self.env.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+                post, files = self.parse_multipart()
+                self._post_args = post
+            ## normal post submission
+            else:
+                self._post_args = self.timed('parse', util.parse_post_vars, self.body)
+        return self._post_args
 
     @property
     def files(self):
-        if self.env['REQUEST_METHOD'] != 'POST':
-            return {}
-        if not self.env.get('CONTENT_TYPE', '') .startswith('multipart/form-data'):
-            return {}
+        """ Return the files uploaded with the request
+
+        Each file is a dict holding the 'filename', 'content_type' and
+        'size' of the upload, and a file-like object as 'file'.
+        """
+        if self._files is None:
+            if self.env['REQUEST_METHOD'] != 'POST':
+                self._files = {}
+            elif not self.env.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+                self._files = {}
+            else:
+                post, files = self.parse_multipart()
+                self._files = files
+        return self._files
+
+    def parse_multipart(self):
+        """ Parse a multipart/form-data body as it is streamed in
+
+        The form fields and the files are filled in by a single pass
+        over the body, and the result is kept for the rest of the
+        request.
+        """
+        if self._multipart is None:
+            self._multipart = self.timed('parse', self.read_multipart)
+        return self._multipart
+
+    def read_multipart(self):
+        """ Read and parse the multipart body """
         content_type = self.env.get('CONTENT_TYPE', '')
-        boundary = content_type.split('boundary=', 1)[1]
-        post, files = util.parse_multipart(self.__raw_data, boundary)
-        return files
+        try:
+            boundary = content_type.split('boundary=', 1)[1]
+        except IndexError:
+            raise HTTPError(status=400)
+        boundary = boundary.split(';', 1)[0].strip().strip('"')
+        parser = util.MultipartParser(boundary, spool_size=self.spool_size,
+                                      max_field_size=self.max_field_size)
+        try:
+            for chunk in self.iter_body():
+                parser.feed(chunk)
+        except util.FieldTooLarge:
+            parser.close()
+            raise HTTPError(status=413)
+        except ValueError:
+            parser.close()
+            raise HTTPError(status=400)
+        return parser.close()
 
     @property
     def cookies(self):
         """ Return the parsed HTTP cookies """
-        try:
-            data = self.env['HTTP_COOKIE']
-            return util.parse_cookie_data(data)
-        except:
-            return {}
+        if self._cookies is None:
+            try:
+                data = self.env['HTTP_COOKIE']
+                self._cookies = self.timed('parse', util.parse_cookie_data, data)
+            except:
+                self._cookies = {}
+        return self._cookies
 
     @property
     def session(self):
         if self._session is None:
+            if self.session_store is None:
+                self.session_store = session.DummyStore()
             session_id = self.cookies.get('session_id', None)
-            self._session = session.Session.load(session_id, self.session_store)
+            self._session = self.timed('session_load', session.Session.load, session_id,
+                                       self.session_store, self.session_serializer)
         return self._session
 
+    def set_etag(self, etag):
+        """ Convenience method to set the ETag of the response """
+        self.add_header('ETag', etag)
+
+    def set_last_modified(self, timestamp):
+        """ Convenience method to set Last-Modified from a unix timestamp """
+        self.add_header('Last-Modified', util.http_date(timestamp))
+
+    def validators(self, *args, **kwargs):
+        """ Return an (etag, last modified timestamp) tuple for the request
+
+        Called with the handler method's arguments before it is run, for
+        GET and HEAD requests. Subclasses can override this to supply
+        cheap validators; either may be None.
+        """
+        return (None, None)
+
+    def not_modified(self):
+        """ Check the request's validators against the response's
+
+        Returns True if the client's copy of the response, as described by
+        If-None-Match or If-Modified-Since, matches the ETag or
+        Last-Modified header of the response.
+        """
+        if (self.env.get('HTTP_IF_NONE_MATCH') is None
+                and self.env.get('HTTP_IF_MODIFIED_SINCE') is None):
+            return False
+        headers = self.headers
+        return util.not_modified(self.env, headers.get('ETag'), headers.get('Last-Modified'))
+
     def execute(self, *args, **kwargs):
         """ Execute our handler
 
@@ -165,16 +566,178 @@ class RequestHandler(object):
         method arguments based on the URL pattern that was defined.
         """
         method = self.env['REQUEST_METHOD']
-        handler = getattr(self, method.lower())
-        data = handler(*args, **kwargs)
-        if self._session is not None and self._session.deleted:
-            self.set_cookie('session_id=%s' %(self._session.session_id), delete=True)
+        name = self.find_method(method)
+        if name is None:
+            raise HTTPError(status=405)
+        handler = getattr(self, name)
+        self.check_body_size()
+        timer = self.timer
+        if timer is not None:
+            timer.begin('handler')
+        try:
+            conditional = method in ('GET', 'HEAD')
+            if conditional:
+                (etag, last_modified) = self.validators(*args, **kwargs)
+                if etag is not None:
+                    self.set_etag(etag)
+                if last_modified is not None:
+                    self.set_last_modified(last_modified)
+                if (etag is not None or last_modified is not None) and self.not_modified():
+                    self.set_status(304)
+                    return []
+            data = handler(*args, **kwargs)
+        finally:
+            if timer is not None:
+                timer.end()
+        body = self.make_body(data)
+        if body is data and not isinstance(body, list):
+            ## the session may still be changed while the body is sent
+            if self._session is not None:
+                self.set_cookie('session_id=%s' %(self._session.session_id,))
+            body = StreamingBody(self, body)
+        elif self._session is not None:
+            self.timed('session_save', self.save_session)
+        if conditional and self.status == 200:
+            if self.auto_etag and isinstance(body, list) and 'ETag' not in self.headers:
+                self.set_etag('"%s"' %(hashlib.md5(''.join(body)).hexdigest(),))
+            if self.not_modified():
+                if hasattr(body, 'close'):
+                    body.close()
+                self.set_status(304)
+                return []
+        ## HEAD requests handled by get() send the headers only
+        if method == 'HEAD' and name == 'get':
+            if isinstance(body, list) and 'Content-Length' not in self.headers:
+                self.add_header('Content-Length', str(sum([len(chunk) for chunk in body])))
+            elif hasattr(body, 'close'):
+                body.close()
+            body = []
+        return body
+
+    def save_session(self):
+        """ Save or delete the session, and set its cookie """
+        self.set_cookie('session_id=%s' %(self._session.session_id,),
+                        delete=self._session.deleted)
+        self.store_session()
+
+    def store_session(self):
+        """ Save or delete the session, without touching its cookie """
+        if self._session.deleted:
             self._session.delete(self.session_store)
             self._session = None
-        elif self._session is not None:
-            self.set_cookie('session_id=%s' %(self._session.session_id))
-            self.session.save(self.session_store)
-        return [data]
+        else:
+            self._session.save(self.session_store)
+
+    @classmethod
+    def cache_key(cls, env):
+        """ Build the response cache key for a request """
+        key = [env.get('PATH_INFO', ''), env.get('QUERY_STRING', '')]
+        for name in cls.cache_vary:
+            name = 'HTTP_' + name.upper().replace('-', '_')
+            key.append(env.get(name, ''))
+        return '\n'.join(key)
+
+    def make_body(self, data):
+        """ Turn the return value of a handler into a WSGI response body
+
+        Strings are sent as a single block. File-like objects are sent
+        through the server's wsgi.file_wrapper if it has one, which may
+        use sendfile, or else read in blocks. Any other iterable, such as
+        a generator, is passed to the server unchanged and is consumed as
+        the response is sent. The server calls close() on the body once
+        it is done, which closes the file or generator.
+        """
+        if isinstance(data, basestring):
+            return [data]
+        if data is None:
+            return []
+        if hasattr(data, 'read'):
+            wrapper = self.env.get('wsgi.file_wrapper', wsgiref.util.FileWrapper)
+            return wrapper(data, self.file_block_size)
+        return data
+
+
+## Python's re module refuses expressions with more than 100 groups,
+## so combined route expressions are split into chunks below that limit
+MAX_COMBINED_GROUPS = 99
+
+## named groups, backreferences, conditionals and inline flags all
+## depend on the group numbering or apply to the whole expression, so
+## patterns using them can not be merged into an alternation
+UNCOMBINABLE_PATTERN = re.compile(r'\(\?P|\(\?\(|\(\?[aiLmsux]|\\[1-9]')
+
+class CombinedDispatcher(object):
+    """ Match a URI against a list of routes in a single regex pass
+
+    Each route pattern is wrapped in a capturing group and joined into
+    one alternation. Alternatives are tried left to right, so the first
+    route in the list that matches still wins, exactly as with a linear
+    scan. The outer group that matched tells us which route it was, and
+    the groups nested inside it are that route's own groups.
+
+    Routes that can not be merged are kept as standalone expressions,
+    and chunks are split there to preserve the route order.
+
+    Attributes:
+        routes  -- list of (compiled regex, handler) tuples
+    """
+    def __init__(self, routes):
+        self.segments = []
+        chunk = []
+        groups = 0
+        for (regex, obj) in routes:
+            if not self.combinable(regex):
+                self.add_chunk(chunk)
+                chunk, groups = [], 0
+                self.segments.append((regex, None, obj))
+                continue
+            if groups + regex.groups + 1 > MAX_COMBINED_GROUPS:
+                self.add_chunk(chunk)
+                chunk, groups = [], 0
+            chunk.append((regex, obj))
+            groups += regex.groups + 1
+        self.add_chunk(chunk)
+
+    def combinable(self, regex):
+        """ Check if a compiled route can be merged with other routes """
+        if regex.flags & ~re.UNICODE:
+            return False
+        if regex.groups + 1 > MAX_COMBINED_GROUPS:
+            return False
+        return UNCOMBINABLE_PATTERN.search(regex.pattern) is None
+
+    def add_chunk(self, chunk):
+        """ Join a chunk of routes into a single expression
+
+        The table maps the index of each route's outer group to the
+        handler and the slice of m.groups() holding the route's groups.
+        """
+        if not chunk:
+            return
+        if len(chunk) == 1:
+            (regex, obj) = chunk[0]
+            self.segments.append((regex, None, obj))
+            return
+        parts = []
+        table = {}
+        index = 1
+        for (regex, obj) in chunk:
+            parts.append('(%s)' %(regex.pattern,))
+            table[index] = (obj, index, index + regex.groups)
+            index += regex.groups + 1
+        self.segments.append((re.compile('|'.join(parts)), table, None))
+
+    def match(self, uri):
+        """ Return a (handler, groups) tuple, or None if nothing matched """
+        for (regex, table, obj) in self.segments:
+            m = regex.match(uri)
+            if m is None:
+                continue
+            if table is None:
+                return (obj, m.groups())
+            (obj, start, end) = table[m.lastindex]
+            return (obj, m.groups()[start:end])
+        return None
 
 
 class Router(object):
@@ -184,6 +747,11 @@ class Router(object):
     regular expression. In the regex, a match can be specified, which will
     be passed to the request handler as method arguments.
 
+    Routes are matched in the order they were added. By default each
+    route's expression is tried in turn; passing dispatch='combined'
+    merges the routes into a CombinedDispatcher, which finds the same
+    route in a single pass over the URI.
+
     Example:
         router = mortimer.web.Router()
         routes = [
@@ -192,43 +760,88 @@ class Router(object):
         ]
         router.set_routes(routes)
         router.add_route((r'/login/?$', LoginHandlerClass))
+
+    Attributes:
+        dispatch    -- route matching strategy, 'scan' or 'combined'
+        version     -- incremented whenever the route list changes
     """
-    def __init__(self):
+    DISPATCH_MODES = ('scan', 'combined')
+
+    def __init__(self, dispatch='scan'):
+        if dispatch not in self.DISPATCH_MODES:
+            raise ValueError('unknown dispatch mode: %s' %(dispatch,))
+        self.dispatch = dispatch
+        self.dispatcher = None
+        self.frozen = False
+        self.version = 0
         self.routes = []
 
     def compile_routes(self):
         """ Compile the route regular expressions
 
         The routes are persisted for the lifetime of the application,
-        and will likely be called many times. We will compile the expressions
-        here to ensure they are cached for the lifetime of our application
+        and will likely be called many times. Routes are compiled as
+        they are added, so this is only needed if the route list was
+        modified directly. Compiling an already compiled expression
+        is a no-op, so this is safe to call more than once.
         """
+        self.check_frozen()
         self.routes = [(re.compile(pattern), obj) for (pattern, obj) in self.routes]
+        ## the combined dispatcher is rebuilt on the next lookup
+        self.dispatcher = None
+        self.version += 1
+
+    def check_frozen(self):
+        if self.frozen:
+            raise RuntimeError('can not modify a frozen router')
 
     def add_route_list(self, routes):
         """ Set the list of routes
 
         This will add the provided list of routes to the router's
-        list of routes. Each route regular expressions will be
-        compiled after they are added.
+        list of routes. Each route regular expression is compiled
+        once, as it is added.
         """
-        for route in routes:
-            self.add_route(route)
-        self.compile_routes()
+        self.check_frozen()
+        self.routes.extend([(re.compile(pattern), obj) for (pattern, obj) in routes])
+        self.dispatcher = None
+        self.version += 1
 
     def add_route(self, route):
         """ Add a route to the route list
 
         This will add a specified route tuple to the route list,
-        compiling the regular expression after it is added.
+        compiling its regular expression. Routes that were added
+        earlier are not recompiled.
         """
-        self.routes.append(route)
-        self.compile_routes()
+        self.check_frozen()
+        (pattern, obj) = route
+        self.routes.append((re.compile(pattern), obj))
+        self.dispatcher = None
+        self.version += 1
+
+    def freeze(self):
+        """ Build the final lookup structure and make the router immutable
+
+        Once frozen, adding routes raises a RuntimeError and lookups
+        never modify the router, so a frozen router can be safely shared
+        between threads.
+        """
+        if self.frozen:
+            return
+        self.routes = tuple(self.routes)
+        if self.dispatch == 'combined':
+            self.dispatcher = CombinedDispatcher(self.routes)
+        self.frozen = True
 
     def find_route(self, uri):
         """ Find a route matching the specified URI
         If no matching route is found, None is returned
         """
+        if self.dispatch == 'combined':
+            if self.dispatcher is None:
+                self.dispatcher = CombinedDispatcher(self.routes)
+            return self.dispatcher.match(uri)
         for (regex, obj) in self.routes:
             m = regex.match(uri)
             if m is not None:
@@ -255,67 +868,184 @@ class WebApplication(object):
 
     Webapplication instances are directly callable and conform to the WSGI
     specification.
+
+    Route lookups can optionally be cached per URI by passing a
+    route_cache_size. Both matches and misses (404s) are cached, and the
+    cache is cleared whenever the router changes.
+
+    Attributes:
+        route_cache_size -- number of URIs to cache route lookups for,
+                            0 disables the cache
+        max_body_size    -- default maximum request body size in bytes
+                            for all handlers, None for no limit
+        response_cache   -- cache.ResponseCache used by handlers that set
+                            cache_ttl; replace it to use another backend
+        stats            -- stats.Stats recording the latency of each
+                            request, None to disable
+        session_store    -- session.BaseStore used by every handler, None
+                            to not keep sessions between requests
+        session_serializer
+                         -- session serializer used by every handler,
+                            None for the default
     """
-    def __init__(self):
+    session_store = None
+    session_serializer = None
+
+    def __init__(self, route_cache_size=0, max_body_size=None, stats=None):
         self.router = Router()
+        self.max_body_size = max_body_size
+        self.response_cache = cache.ResponseCache()
+        self.stats = stats
+        self.route_cache = None
+        self.route_cache_router = None
+        self.route_cache_version = None
+        if route_cache_size:
+            self.route_cache = util.SegmentedLRUCache(route_cache_size)
+
+    def lookup_route(self, uri):
+        """ Find a route matching the requested URI, or return None """
+        if self.route_cache is None:
+            return self.router.find_route(uri)
+        return self.find_cached_route(uri)
 
     def find_route(self, uri):
-        """ Find a route matching the requested URI """
-        handler = self.router.find_route(uri)
+        """ Find a route matching the requested URI
+
+        An HTTPError with a 404 status is raised if there is none.
+        """
+        handler = self.lookup_route(uri)
         if handler is None:
             raise HTTPError(status=404)
         return handler
 
+    def find_cached_route(self, uri):
+        """ Find a route, consulting the route cache first
+
+        The cache is cleared if routes were added, or the router
+        replaced, since the cache was last filled.
+        """
+        router = self.router
+        if (router is not self.route_cache_router
+                or router.version != self.route_cache_version):
+            self.route_cache.clear()
+            self.route_cache_router = router
+            self.route_cache_version = router.version
+        version = router.version
+        handler = self.route_cache.get(uri, util.MISSING)
+        if handler is util.MISSING:
+            handler = router.find_route(uri)
+            ## don't cache a lookup that raced with a route change
+            if router.version == version:
+                self.route_cache.set(uri, handler)
+        return handler
+
+    def cached_response(self, handler, args, env, callback):
+        """ Send a response from the response cache
+
+        The response is only computed if it is missing or stale. Its body
+        is buffered, so it can be stored.
+        """
+        def compute():
+            ## the cached response must be the full response, not
+            ## a 304 for this particular client
+            request_env = dict(env)
+            request_env.pop('HTTP_IF_NONE_MATCH', None)
+            request_env.pop('HTTP_IF_MODIFIED_SINCE', None)
+            h = handler(self, request_env)
+            ret = h.execute(*args)
+            ## a body that fails part way must not be cached, so its
+            ## exception is let through to become an error page
+            if isinstance(ret, StreamingBody):
+                body = ret.read()
+            else:
+                try:
+                    body = ''.join(ret)
+                finally:
+                    if hasattr(ret, 'close'):
+                        ret.close()
+            status = util.code_to_status(h.status)
+            return cache.CachedResponse(status, list(h.response_headers()), body)
+        key = handler.cache_key(env)
+        response = self.response_cache.fetch(key, handler.cache_ttl, compute)
+        if 'HTTP_IF_NONE_MATCH' in env or 'HTTP_IF_MODIFIED_SINCE' in env:
+            headers = util.Headers(response.headers)
+            if util.not_modified(env, headers.get('ETag'), headers.get('Last-Modified')):
+                callback(util.code_to_status(304), list(response.headers))
+                return iter([])
+        callback(response.status, list(response.headers))
+        return iter([response.body])
+
     def __call__(self, env, callback):
         """ Called to execute the request """
+        if self.stats is not None:
+            return self.stats.measure(self.handle_request, env, callback)
+        return self.handle_request(env, callback)
+
+    def handle_request(self, env, callback):
+        """ Route the request to its handler and run it """
         uri = env['PATH_INFO']
         try:
-            handler, args = self.find_route(uri)
+            timer = env.get(stats.TIMER_KEY)
+            if timer is None:
+                route = self.lookup_route(uri)
+            else:
+                route = timer.call('route', self.lookup_route, uri)
+            ## unknown routes and methods are common enough, such as
+            ## from scanners, that they are answered without raising
+            if route is None:
+                return self.send_error(404, callback)
+            handler, args = route
+            if timer is not None:
+                timer.route = handler.route_name()
+            if handler.find_method(env['REQUEST_METHOD']) is None:
+                return self.send_error(405, callback, handler.dispatch_table()[1])
+            if (getattr(handler, 'cache_ttl', None) is not None
+                    and env['REQUEST_METHOD'] == 'GET'
+                    and self.response_cache is not None):
+                return self.cached_response(handler, args, env, callback)
             h = handler(self, env)
             ret = h.execute(*args)
             status = util.code_to_status(h.status)
-            callback(status, h.headers)
-            return iter(ret)
-        ## if a request is made via a method we have not implemented
-        ## a request handler for, an AttributeError with be raised
-        ## a 405 Method Not ALlowed status might work here, but for
-        ## now we will just send a 404 status
-        except AttributeError:
-            traceback.print_exc(file=env['wsgi.errors'])
-            handler = ErrorRequestHandler(self, env, status=404)
-            status = util.code_to_status(handler.status)
-            callback(status, handler.headers)
-            return iter(handler.execute())
+            callback(status, h.response_headers())
+            ## streaming bodies have to reach the server unchanged, so
+            ## it can use wsgi.file_wrapper and call close()
+            if isinstance(ret, list):
+                return iter(ret)
+            return ret
         ## if an HTTPError was thrown, send down an error page
-        ## based on the thrown HTTP status code
+        ## based on the thrown HTTP status code. These are expected
+        ## responses, so no traceback is logged
         except HTTPError, e:
-            traceback.print_exc(file=env['wsgi.errors'])
-            handler = ErrorRequestHandler(self, env, status=e.status)
-            status = util.code_to_status(handler.status)
-            callback(status, handler.headers)
-            return iter(handler.execute())
+            return self.send_error(e.status, callback)
         ## return a 500 Internal Server Error page if any
         ## other exceptions have been thrown. We will also send
         ## a traceback for further investigation of the error
         except:
             traceback.print_exc(file=env['wsgi.errors'])
-            handler = ErrorRequestHandler(self, env, status=500)
-            status = util.code_to_status(handler.status)
-            callback(status, handler.headers)
-            return iter(handler.execute())
+            return self.send_error(500, callback)
+
+    def send_error(self, status, callback, allow=None):
+        """ Send a canned error response """
+        (line, headers, body) = error_response(status, allow)
+        callback(line, list(headers))
+        return iter([body])
 
 class ErrorRequestHandler(RequestHandler):
     """ Generate error pages based on HTTP status codes
 
     When supplied with an HTTP status code (most likely from a thrown
     HTTPError), generate an error page with a short status message,
-    taken from httplib.responses for the specified status code
+    taken from httplib.responses for the specified status code.
+    WebApplication sends the same page with error_response(), without
+    creating a handler.
 
     Attributes:
         application -- Instance of WebApplication from which we were called
         env         -- WSGI environment dict
         status      -- HTTP status code
     """
+    __slots__ = ()
+
     def __init__(self, application, env, status=404):
         super(ErrorRequestHandler, self).__init__(application, env)
         self.status = status
@@ -328,6 +1058,156 @@ class ErrorRequestHandler(RequestHandler):
     def execute(self):
         return util.code_to_status(self.status)
 
+class StaticFileHandler(RequestHandler):
+    """ Serve files from a directory
+
+    The route for the handler captures the path of the requested file,
+    relative to the root directory. mount() creates a handler class for
+    a given root:
+
+        router.add_route((r'^/static/(.*)$', StaticFileHandler.mount('/srv/static')))
+
+    Files are streamed to the client through wsgi.file_wrapper when the
+    server provides it. The results of os.stat are cached for
+    stat_cache_ttl seconds, so conditional requests answered with a 304
+    from the cached ETag and Last-Modified do no file system access.
+    Single byte ranges are supported. If the client accepts gzip, a
+    precompressed '.gz' sibling of the file is sent in its place.
+
+    Attributes:
+        root            -- directory to serve files from
+        max_age         -- if set, the max-age sent in Cache-Control
+        stat_cache_ttl  -- number of seconds to cache file stats for
+    """
+    __slots__ = ()
+
+    root = None
+    max_age = None
+    stat_cache_ttl = 2.0
+    stat_cache = util.LRUCache(1024)
+
+    @classmethod
+    def mount(cls, root, **kwargs):
+        """ Return a StaticFileHandler class serving files from root
+
+        Any keyword arguments override the class attributes of the
+        returned class, such as max_age.
+        """
+        kwargs['root'] = os.path.abspath(root)
+        kwargs.setdefault('__slots__', ())
+        ## every mounted class has the same name, so the stats tell
+        ## them apart by their root
+        kwargs.setdefault('stats_name', '%s.%s(%s)' %(cls.__module__, cls.__name__, kwargs['root']))
+        return type(cls.__name__, (cls,), kwargs)
+
+    def resolve(self, path):
+        """ Return the file name for a path, refusing to leave the root """
+        if self.root is None or '\0' in path:
+            raise HTTPError(status=404)
+        filename = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+        if not filename.startswith(self.root.rstrip(os.sep) + os.sep):
+            raise HTTPError(status=404)
+        return filename
+
+    def stat_file(self, filename):
+        """ Return a cached (mtime, size, etag) tuple for a regular file
+
+        None is returned (and cached) if the file does not exist.
+        """
+        now = time.time()
+        entry = self.stat_cache.get(filename)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            st = os.stat(filename)
+        except OSError:
+            info = None
+        else:
+            info = None
+            if stat.S_ISREG(st.st_mode):
+                mtime = int(st.st_mtime)
+                info = (mtime, st.st_size, '"%x-%x"' %(mtime, st.st_size))
+        self.stat_cache.set(filename, (now + self.stat_cache_ttl, info))
+        return info
+
+    def get(self, path):
+        filename = self.resolve(path)
+        info = self.stat_file(filename)
+        if info is None:
+            raise HTTPError(status=404)
+        ctype, encoding = mimetypes.guess_type(filename)
+        self.set_content_type(ctype or 'application/octet-stream')
+
+        range_header = self.env.get('HTTP_RANGE')
+        gz_info = None
+        if encoding is None:
+            gz_info = self.stat_file(filename + '.gz')
+        if gz_info is not None:
+            self.add_header('Vary', 'Accept-Encoding')
+            accept = self.env.get('HTTP_ACCEPT_ENCODING', '')
+            if range_header is None and util.accepts_encoding(accept, 'gzip'):
+                filename = filename + '.gz'
+                info = gz_info
+                self.add_header('Content-Encoding', 'gzip')
+
+        (mtime, size, etag) = info
+        self.set_etag(etag)
+        self.set_last_modified(mtime)
+        self.add_header('Accept-Ranges', 'bytes')
+        if self.max_age is not None:
+            self.add_header('Cache-Control', 'max-age=%d' %(self.max_age,))
+        if self.not_modified():
+            self.set_status(304)
+            return ''
+
+        byte_range = None
+        if range_header is not None:
+            if_range = self.env.get('HTTP_IF_RANGE')
+            if if_range is None or if_range == etag:
+                byte_range = util.parse_byte_range(range_header, size)
+        if byte_range is not None and byte_range[0] >= size:
+            self.set_status(416)
+            self.add_header('Content-Range', 'bytes */%d' %(size,))
+            return ''
+
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            raise HTTPError(status=404)
+        ## the cached stat may be stale, send the real size
+        size = os.fstat(f.fileno()).st_size
+        if byte_range is None:
+            self.add_header('Content-Length', str(size))
+            return f
+        (start, end) = (byte_range[0], min(byte_range[1], size - 1))
+        self.set_status(206)
+        self.add_header('Content-Range', 'bytes %d-%d/%d' %(start, end, size))
+        self.add_header('Content-Length', str(end - start + 1))
+        return util.iter_file_range(f, start, end - start + 1, self.file_block_size)
+
+    def head(self, path):
+        body = self.get(path)
+        if hasattr(body, 'close'):
+            body.close()
+        return ''
+
+
+class StatsHandler(RequestHandler):
+    """ Report the application's request statistics as JSON
+
+        router.add_route((r'^/_stats$', StatsHandler))
+
+    A 404 is sent if the application does not keep stats.
+    """
+    __slots__ = ()
+
+    def get(self):
+        if self.application.stats is None:
+            raise HTTPError(status=404)
+        self.set_content_type('application/json')
+        return json.dumps(self.application.stats.snapshot())
+
+
 class HTTPError(Exception):
     """ HTTP error exception
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import time
+import StringIO
+import threading
+import unittest
+import mortimer.web
+import mortimer.cache
+from webapplication_test import FakeWSGIRequest
+
+def make_response(body='body', headers=None):
+    return mortimer.cache.CachedResponse('200 OK', headers or [], body)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = mortimer.cache.ResponseCache()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return make_response('body %d' % self.calls)
+
+    def test_fetch(self):
+        first = self.cache.fetch('key', 60, self.compute)
+        second = self.cache.fetch('key', 60, self.compute)
+        self.assertEqual(first.body, 'body 1')
+        self.assertEqual(second.body, 'body 1')
+        self.assertEqual(self.calls, 1)
+
+    def test_expiry(self):
+        self.cache.fetch('key', 60, self.compute)
+        self.cache.backend.get('key').expires = time.time() - 1
+        self.assertEqual(self.cache.fetch('key', 60, self.compute).body, 'body 2')
+
+    def test_not_cacheable(self):
+        compute = lambda: make_response(headers=[('Set-Cookie', 'a=1')])
+        self.cache.fetch('key', 60, compute)
+        self.assertEqual(self.cache.backend.get('key'), None)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        def slow_compute():
+            started.set()
+            time.sleep(0.1)
+            return self.compute()
+        results = []
+        def fetch():
+            results.append(self.cache.fetch('key', 60, slow_compute).body)
+        leader = threading.Thread(target=fetch)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=fetch) for i in range(5)]
+        for t in followers:
+            t.start()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ['body 1'] * 6)
+
+    def test_stale_while_recomputing(self):
+        self.cache.fetch('key', 60, self.compute)
+        self.cache.backend.get('key').expires = time.time() - 1
+        def recompute():
+            ## a concurrent request gets the stale copy
+            stale = self.cache.fetch('key', 60, self.compute)
+            self.assertEqual(stale.body, 'body 1')
+            return make_response('fresh')
+        self.assertEqual(self.cache.fetch('key', 60, recompute).body, 'fresh')
+        self.assertEqual(self.calls, 1)
+
+
+class TestCachedHandler(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        calls = self.calls
+        class Controller(mortimer.web.RequestHandler):
+            cache_ttl = 60
+            cache_vary = ('Accept-Language',)
+            auto_etag = True
+            def get(self):
+                calls.append(1)
+                return 'response %d' % len(calls)
+        self.application = mortimer.web.WebApplication()
+        self.application.router.add_route((r'/$', Controller))
+        self.fake_req = None
+
+    def request(self, **env):
+        self.fake_req = FakeWSGIRequest()
+        self.fake_req.environ.update(env)
+        return ''.join(self.fake_req.run_application(self.application))
+
+    def test_cached(self):
+        self.assertEqual(self.request(), 'response 1')
+        self.assertEqual(self.request(), 'response 1')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_cache_key(self):
+        self.assertEqual(self.request(QUERY_STRING='a=1'), 'response 1')
+        self.assertEqual(self.request(QUERY_STRING='a=2'), 'response 2')
+        self.assertEqual(self.request(HTTP_ACCEPT_LANGUAGE='de'), 'response 3')
+        self.assertEqual(self.request(QUERY_STRING='a=1'), 'response 1')
+
+    def test_not_modified(self):
+        self.assertEqual(self.request(), 'response 1')
+        etag = dict(self.fake_req.headers)['ETag']
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH=etag), '')
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_not_modified_since(self):
+        class Controller(mortimer.web.RequestHandler):
+            cache_ttl = 60
+            def get(self):
+                self.set_last_modified(1000000000)
+                return 'dated'
+        self.application.router.add_route((r'/dated$', Controller))
+        self.assertEqual(self.request(PATH_INFO='/dated'), 'dated')
+        last_modified = dict(self.fake_req.headers)['Last-Modified']
+        self.assertEqual(self.request(PATH_INFO='/dated', HTTP_IF_MODIFIED_SINCE=last_modified), '')
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+        self.request(PATH_INFO='/dated', HTTP_IF_MODIFIED_SINCE=last_modified,
+                     HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(self.fake_req.status, '200 OK')
+
+    def test_failed_stream_not_cached(self):
+        calls = self.calls
+        class Controller(mortimer.web.RequestHandler):
+            cache_ttl = 60
+            def get(self):
+                calls.append(1)
+                yield 'head;'
+                if len(calls) == 1:
+                    raise ValueError('broken')
+                yield 'tail'
+        self.application.router.add_route((r'/stream$', Controller))
+        errors = StringIO.StringIO()
+        self.assertEqual(self.request(PATH_INFO='/stream', **{'wsgi.errors': errors}),
+                         '500 Internal Server Error')
+        self.assertEqual(self.fake_req.status, '500 Internal Server Error')
+        self.assertTrue('ValueError' in errors.getvalue())
+        self.assertEqual(self.request(PATH_INFO='/stream'), 'head;tail')
+        self.assertEqual(self.fake_req.status, '200 OK')
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import zlib
+import gzip
+import StringIO
+import unittest
+import mortimer.web
+import mortimer.compress
+from webapplication_test import FakeWSGIRequest
+
+PAGE = '<html>' + 'hello world ' * 100 + '</html>'
+
+class PageController(mortimer.web.RequestHandler):
+    def get(self):
+        return PAGE
+
+class SmallController(mortimer.web.RequestHandler):
+    def get(self):
+        return 'small'
+
+class StreamController(mortimer.web.RequestHandler):
+    def get(self):
+        for i in range(100):
+            yield 'line %d\n' % i
+
+class ImageController(mortimer.web.RequestHandler):
+    def get(self):
+        self.set_content_type('image/png')
+        return PAGE
+
+
+class ETagController(mortimer.web.RequestHandler):
+    def get(self):
+        self.set_etag('"v1"')
+        if self.not_modified():
+            self.set_status(304)
+            return ''
+        return PAGE
+
+
+class TestCompressionMiddleware(unittest.TestCase):
+    def setUp(self):
+        application = mortimer.web.WebApplication()
+        application.router.add_route_list([
+            (r'/$', PageController),
+            (r'/small$', SmallController),
+            (r'/stream$', StreamController),
+            (r'/image$', ImageController),
+            (r'/etag$', ETagController),
+        ])
+        self.app = mortimer.compress.CompressionMiddleware(application)
+        self.fake_req = FakeWSGIRequest()
+
+    def request(self, path, accept='gzip, deflate'):
+        self.fake_req.set_path_info(path)
+        self.fake_req.environ['HTTP_ACCEPT_ENCODING'] = accept
+        return ''.join(self.fake_req.run_application(self.app))
+
+    def header(self, name):
+        return dict(self.fake_req.headers).get(name)
+
+    def test_gzip(self):
+        data = self.request('/')
+        self.assertEqual(self.header('Content-Encoding'), 'gzip')
+        self.assertEqual(self.header('Vary'), 'Accept-Encoding')
+        self.assertEqual(self.header('Content-Length'), str(len(data)))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(data)).read(), PAGE)
+
+    def test_etag(self):
+        self.request('/etag')
+        self.assertEqual(self.header('ETag'), '"v1-gzip"')
+        self.request('/etag', accept='identity')
+        self.assertEqual(self.header('ETag'), '"v1"')
+
+    def test_etag_not_modified(self):
+        self.fake_req.environ['HTTP_IF_NONE_MATCH'] = '"v1-gzip"'
+        self.request('/etag')
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+        self.assertEqual(self.header('ETag'), '"v1-gzip"')
+        self.fake_req.environ['HTTP_IF_NONE_MATCH'] = '"v1-gzip"'
+        self.request('/etag', accept='deflate')
+        self.assertEqual(self.fake_req.status, '200 OK')
+        self.assertEqual(self.header('ETag'), '"v1-deflate"')
+
+    def test_deflate(self):
+        data = self.request('/', accept='deflate')
+        self.assertEqual(self.header('Content-Encoding'), 'deflate')
+        self.assertEqual(zlib.decompress(data), PAGE)
+
+    def test_not_accepted(self):
+        self.assertEqual(self.request('/', accept='identity'), PAGE)
+        self.assertEqual(self.header('Content-Encoding'), None)
+
+    def test_skipped_responses(self):
+        self.assertEqual(self.request('/small'), 'small')
+        self.assertEqual(self.header('Content-Encoding'), None)
+        self.assertEqual(self.request('/image'), PAGE)
+        self.assertEqual(self.header('Content-Encoding'), None)
+
+    def test_streaming(self):
+        data = self.request('/stream')
+        self.assertEqual(self.header('Content-Encoding'), 'gzip')
+        self.assertEqual(self.header('Content-Length'), None)
+        expected = ''.join('line %d\n' % i for i in range(100))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(data)).read(), expected)
+
+    def test_late_start_response(self):
+        closed = []
+        class Body(object):
+            def __init__(self, start_response, content_type):
+                self.start_response = start_response
+                self.content_type = content_type
+            def __iter__(self):
+                self.start_response('200 OK', [('Content-type', self.content_type)])
+                yield 'first\n'
+                yield PAGE
+            def close(self):
+                closed.append(1)
+        def application(env, start_response):
+            return Body(start_response, env['CONTENT_TYPE'])
+        app = mortimer.compress.CompressionMiddleware(application)
+        self.fake_req.environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        self.fake_req.environ['CONTENT_TYPE'] = 'text/html'
+        data = ''.join(self.fake_req.run_application(app))
+        self.assertEqual(self.header('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(data)).read(), 'first\n' + PAGE)
+        self.fake_req.environ['CONTENT_TYPE'] = 'image/png'
+        data = ''.join(self.fake_req.run_application(app))
+        self.assertEqual(self.header('Content-Encoding'), None)
+        self.assertEqual(data, 'first\n' + PAGE)
+        self.assertEqual(closed, [1, 1])
+
+    def test_written_body_closed(self):
+        closed = []
+        class Body(list):
+            def close(self):
+                closed.append(1)
+        def application(env, start_response):
+            write = start_response('200 OK', [('Content-type', 'image/png')])
+            write('written;')
+            return Body(['returned'])
+        app = mortimer.compress.CompressionMiddleware(application)
+        self.fake_req.environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        self.assertEqual(''.join(self.fake_req.run_application(app)), 'written;returned')
+        self.assertEqual(closed, [1])
+
+    def test_cache(self):
+        first = self.request('/')
+        second = self.request('/')
+        self.assertEqual(first, second)
+        self.assertEqual(self.app.cache.hits, 1)
+        self.assertEqual(self.app.cache.misses, 1)
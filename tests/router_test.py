@@ -40,3 +40,71 @@ class TestRouter(unittest.TestCase):
         self.assertNotEqual(route, None)
         (handler, groups) = route
         self.assertEqual(groups[0], '7')
+
+
+class TestCombinedRouter(TestRouter):
+    def setUp(self):
+        self.router = mortimer.web.Router(dispatch='combined')
+
+    def test_first_match_wins(self):
+        self.router.add_route_list([
+            (r'/item/(\d+)/?$', 'first'),
+            (r'/item/(\w+)/?$', 'second'),
+            (r'/item/(\d+)/(\d+)/?$', 'third'),
+        ])
+        self.assertEqual(self.router.find_route('/item/7'), ('first', ('7',)))
+        self.assertEqual(self.router.find_route('/item/x'), ('second', ('x',)))
+        self.assertEqual(self.router.find_route('/item/1/2'), ('third', ('1', '2')))
+
+    def test_optional_groups(self):
+        self.router.add_route_list([
+            (r'/a/(\d+)?/?$', 'a'),
+            (r'/b/(x)?(y)?$', 'b'),
+        ])
+        self.assertEqual(self.router.find_route('/a/'), ('a', (None,)))
+        self.assertEqual(self.router.find_route('/b/y'), ('b', (None, 'y')))
+
+    def test_uncombinable_routes(self):
+        self.router.add_route_list([
+            (r'/one/(\d+)$', 'one'),
+            (r'/(?P<name>\w+)/(?P=name)$', 'backref'),
+            (r'/three/(\d+)$', 'three'),
+        ])
+        self.assertEqual(self.router.find_route('/one/1'), ('one', ('1',)))
+        self.assertEqual(self.router.find_route('/ab/ab'), ('backref', ('ab',)))
+        self.assertEqual(self.router.find_route('/three/3'), ('three', ('3',)))
+        self.assertEqual(self.router.find_route('/ab/cd'), None)
+
+    def test_large_route_table(self):
+        routes = [(r'/r%d/(\d+)/(\w+)$' % i, i) for i in range(500)]
+        self.router.add_route_list(routes)
+        self.assertEqual(self.router.find_route('/r0/1/a'), (0, ('1', 'a')))
+        self.assertEqual(self.router.find_route('/r499/2/b'), (499, ('2', 'b')))
+        self.assertEqual(self.router.find_route('/r500/2/b'), None)
+
+    def test_invalid_dispatch(self):
+        self.assertRaises(ValueError, mortimer.web.Router, dispatch='trie')
+
+
+class TestRouterFreeze(unittest.TestCase):
+    def setUp(self):
+        self.router = mortimer.web.Router(dispatch='combined')
+        self.router.add_route_list([(r'/$', 'index'), (r'/(\d+)$', 'item')])
+
+    def test_routes_compiled_once(self):
+        compiled = self.router.routes[0][0]
+        self.router.add_route((r'/login/?$', 'login'))
+        self.router.compile_routes()
+        self.assertTrue(self.router.routes[0][0] is compiled)
+
+    def test_freeze(self):
+        self.router.freeze()
+        self.assertTrue(self.router.frozen)
+        self.assertNotEqual(self.router.dispatcher, None)
+        self.assertEqual(self.router.find_route('/7'), ('item', ('7',)))
+
+    def test_frozen_router_is_immutable(self):
+        self.router.freeze()
+        self.assertRaises(RuntimeError, self.router.add_route, (r'/x$', None))
+        self.assertRaises(RuntimeError, self.router.add_route_list, [(r'/x$', None)])
+        self.assertRaises(RuntimeError, self.router.compile_routes)
@@ -5,6 +5,13 @@ import unittest
 TEST_MODULES = [
     'router_test',
     'webapplication_test',
+    'util_test',
+    'static_test',
+    'compress_test',
+    'cache_test',
+    'view_test',
+    'session_test',
+    'stats_test',
 ]
 
 if __name__ == '__main__':
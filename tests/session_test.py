@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import mortimer.session
+
+class RecordingStore(mortimer.session.BaseStore):
+    def __init__(self):
+        self.data = {}
+        self.loads = 0
+        self.saves = 0
+
+    def save(self, session_id, data):
+        self.saves += 1
+        self.data[session_id] = data
+
+    def load(self, session_id):
+        self.loads += 1
+        return self.data[session_id]
+
+    def delete(self, session_id):
+        self.data.pop(session_id, None)
+
+
+class TestCachedStore(unittest.TestCase):
+    def setUp(self):
+        self.backend = RecordingStore()
+        self.store = mortimer.session.CachedStore(self.backend, flush_interval=60)
+
+    def tearDown(self):
+        self.store.close()
+
+    def save_session(self, **data):
+        session = mortimer.session.Session(session_id='abc')
+        session.update(data)
+        session.dirty = True
+        session.save(self.store)
+
+    def test_write_back(self):
+        self.save_session(user='bob')
+        self.save_session(user='alice')
+        self.assertEqual(self.backend.saves, 0)
+        self.store.flush()
+        self.assertEqual(self.backend.saves, 1)
+        session = mortimer.session.Session.load('abc', self.backend)
+        self.assertEqual(session['user'], 'alice')
+
+    def test_cached_load(self):
+        self.save_session(user='bob')
+        self.store.flush()
+        for i in range(3):
+            session = mortimer.session.Session.load('abc', self.store)
+            self.assertEqual(session['user'], 'bob')
+        self.assertEqual(self.backend.loads, 0)
+
+    def test_load_through(self):
+        self.save_session(user='bob')
+        self.store.flush()
+        store = mortimer.session.CachedStore(self.backend, flush_interval=60)
+        mortimer.session.Session.load('abc', store)
+        mortimer.session.Session.load('abc', store)
+        self.assertEqual(self.backend.loads, 1)
+        store.close()
+
+    def test_max_dirty(self):
+        store = mortimer.session.CachedStore(self.backend, flush_interval=60, max_dirty=2)
+        for session_id in ('a', 'b'):
+            session = mortimer.session.Session(data={'x': 1}, session_id=session_id)
+            session.dirty = True
+            session.save(store)
+        self.assertEqual(self.backend.saves, 2)
+        store.close()
+
+    def test_write_through(self):
+        store = mortimer.session.CachedStore(self.backend, flush_interval=0)
+        session = mortimer.session.Session(data={'x': 1}, session_id='abc')
+        session.dirty = True
+        session.save(store)
+        self.assertEqual(self.backend.saves, 1)
+
+    def test_delete(self):
+        self.save_session(user='bob')
+        self.store.delete('abc')
+        self.store.flush()
+        session = mortimer.session.Session.load('abc', self.store)
+        self.assertEqual(dict(session), {})
+
+    def test_close(self):
+        self.save_session(user='bob')
+        self.store.close()
+        self.assertEqual(self.backend.saves, 1)
+
+    def test_delete_while_flushing(self):
+        store = self.store
+        class DeletingStore(RecordingStore):
+            def save(self, session_id, data):
+                super(DeletingStore, self).save(session_id, data)
+                store.delete(session_id)
+                try:
+                    self.loaded = store.load(session_id)
+                except KeyError:
+                    self.loaded = None
+        self.backend = store.store = DeletingStore()
+        self.save_session(user='bob')
+        store.flush()
+        self.assertEqual(self.backend.loaded, None)
+        self.assertFalse('abc' in self.backend.data)
+        self.assertRaises(KeyError, store.load, 'abc')
+
+    def test_collected(self):
+        import gc
+        import weakref
+        store = mortimer.session.CachedStore(self.backend, flush_interval=60)
+        store.start_flusher()
+        ref = weakref.ref(store)
+        flusher = store.flusher
+        del store
+        gc.collect()
+        self.assertTrue(ref() is None)
+        flusher.join(5)
+        self.assertFalse(flusher.is_alive())
+
+
+class TestSerializers(unittest.TestCase):
+    def roundtrip(self, serializer):
+        store = RecordingStore()
+        session = mortimer.session.Session(session_id='abc', serializer=serializer)
+        session['user'] = 'bob'
+        session['items'] = [1, 2, 3]
+        session.save(store)
+        loaded = mortimer.session.Session.load('abc', store, serializer)
+        self.assertEqual(dict(loaded), {'user': 'bob', 'items': [1, 2, 3]})
+        return store.data['abc']
+
+    def test_base(self):
+        serializer = mortimer.session.BaseSerializer()
+        self.assertEqual(serializer.loads(serializer.dumps({'a': 1})), {})
+
+    def test_pickle(self):
+        self.roundtrip(mortimer.session.PickleSerializer())
+
+    def test_json(self):
+        data = self.roundtrip(mortimer.session.JSONSerializer())
+        self.assertEqual(data[0], 'j')
+        self.assertFalse(' ' in data)
+
+    def test_json_compressed(self):
+        data = self.roundtrip(mortimer.session.JSONSerializer(compress_threshold=10))
+        self.assertEqual(data[0], 'z')
+
+    def test_json_invalid(self):
+        serializer = mortimer.session.JSONSerializer()
+        self.assertRaises(ValueError, serializer.loads, '(dp1\n.')
+
+
+class DeltaStore(RecordingStore):
+    supports_delta = True
+
+    def __init__(self):
+        super(DeltaStore, self).__init__()
+        self.deltas = []
+
+    def save_delta(self, session_id, updates, removed, serializer):
+        self.deltas.append((updates, removed))
+
+
+class TestDirtyTracking(unittest.TestCase):
+    def setUp(self):
+        self.store = RecordingStore()
+        session = mortimer.session.Session(data={'a': 1, 'b': [1]}, session_id='abc')
+        session.dirty = True
+        session.save(self.store)
+        self.store.saves = 0
+
+    def load(self, **kwargs):
+        return mortimer.session.Session.load('abc', self.store, **kwargs)
+
+    def test_unchanged(self):
+        session = self.load()
+        session['a'] = 1
+        session.get('a')
+        session.save(self.store)
+        self.assertEqual(self.store.saves, 0)
+
+    def test_changed_type(self):
+        session = self.load()
+        for value in (True, 1.0, u'1'):
+            session['a'] = value
+            session.save(self.store)
+        self.assertEqual(self.store.saves, 3)
+        self.assertEqual(type(session['a']), unicode)
+
+    def test_mutators(self):
+        mutations = [
+            lambda s: s.update(c=3),
+            lambda s: s.pop('a'),
+            lambda s: s.popitem(),
+            lambda s: s.setdefault('c', 3),
+            lambda s: s.clear(),
+            lambda s: s.__delitem__('a'),
+        ]
+        for mutate in mutations:
+            session = self.load()
+            mutate(session)
+            self.assertTrue(session.dirty)
+        session = self.load()
+        session.setdefault('a', 2)
+        session.pop('missing', None)
+        self.assertFalse(session.dirty)
+
+    def test_change_sets(self):
+        session = self.load()
+        session['c'] = 3
+        del session['a']
+        session['a'] = 4
+        del session['b']
+        self.assertEqual(session.changed, set(['a', 'c']))
+        self.assertEqual(session.removed, set(['b']))
+
+    def test_nested(self):
+        session = self.load()
+        session['b'].append(2)
+        session.save(self.store)
+        self.assertEqual(self.store.saves, 0)
+        mortimer.session.Session.track_nested = True
+        try:
+            session = self.load()
+            session.save(self.store)
+            self.assertEqual(self.store.saves, 0)
+            session['b'].append(2)
+            session.save(self.store)
+            self.assertEqual(self.store.saves, 1)
+        finally:
+            mortimer.session.Session.track_nested = False
+
+    def test_delta(self):
+        store = DeltaStore()
+        store.data = self.store.data
+        session = mortimer.session.Session.load('abc', store)
+        session['c'] = 3
+        del session['a']
+        session.save(store)
+        self.assertEqual(store.deltas, [({'c': 3}, set(['a']))])
+        self.assertEqual(store.saves, 0)
+
+    def test_new_session_saved_whole(self):
+        store = DeltaStore()
+        session = mortimer.session.Session.load('new', store)
+        session['a'] = 1
+        session.save(store)
+        self.assertEqual(store.saves, 1)
+        self.assertEqual(store.deltas, [])
+
+    def test_legacy_pickle(self):
+        import cPickle
+        session = mortimer.session.Session(data={'a': 1}, session_id='abc')
+        self.store.data['abc'] = cPickle.dumps(session)
+        self.assertEqual(dict(self.load()), {'a': 1})
+
+
+class TestFileStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def age(self, store, session_id, seconds):
+        past = time.time() - seconds
+        os.utime(store.filename(session_id), (past, past))
+
+    def test_save_load(self):
+        store = mortimer.session.FileStore(self.path)
+        store.save('abc', 'data')
+        self.assertEqual(store.load('abc'), 'data')
+        self.assertEqual(os.listdir(self.path), ['session-abc'])
+        store.delete('abc')
+        self.assertRaises(IOError, store.load, 'abc')
+
+    def test_sharded(self):
+        store = mortimer.session.FileStore(self.path, shard_depth=2)
+        store.save('abc', 'data')
+        fname = store.filename('abc')
+        self.assertEqual(len(os.path.relpath(fname, self.path).split(os.sep)), 3)
+        self.assertEqual(os.listdir(os.path.dirname(fname)), ['session-abc'])
+        self.assertEqual(store.load('abc'), 'data')
+
+    def test_invalid_session_id(self):
+        store = mortimer.session.FileStore(self.path)
+        self.assertRaises(ValueError, store.load, '../etc/passwd')
+        self.assertRaises(ValueError, store.save, '../x', 'data')
+
+    def test_ttl(self):
+        store = mortimer.session.FileStore(self.path, ttl=60)
+        store.save('abc', 'data')
+        self.age(store, 'abc', 40)
+        self.assertEqual(store.load('abc'), 'data')
+        ## loading refreshed the session
+        self.assertTrue(os.stat(store.filename('abc')).st_mtime > time.time() - 10)
+        self.age(store, 'abc', 120)
+        self.assertRaises(IOError, store.load, 'abc')
+        self.assertFalse(os.path.exists(store.filename('abc')))
+
+    def test_sweep(self):
+        store = mortimer.session.FileStore(self.path, shard_depth=1, ttl=60)
+        for i in range(10):
+            store.save('s%d' % i, 'data')
+            if i % 2:
+                self.age(store, 's%d' % i, 120)
+        removed = [store.sweep(limit=4) for i in range(4)]
+        self.assertEqual(sum(removed), 5)
+        self.assertTrue(max(removed) <= 4)
+        self.assertEqual(store.load('s0'), 'data')
+        self.assertRaises(IOError, store.load, 's1')
+
+    def test_sweep_every(self):
+        store = mortimer.session.FileStore(self.path, ttl=60, sweep_every=2)
+        store.save('old', 'data')
+        self.age(store, 'old', 120)
+        store.save('new', 'data')
+        store.sweeper.join()
+        self.assertEqual(os.listdir(self.path), ['session-new'])
+
+    def test_sweep_foreign_files(self):
+        store = mortimer.session.FileStore(self.path, ttl=60)
+        foreign = os.path.join(self.path, 'other')
+        open(foreign, 'w').close()
+        os.utime(foreign, (0, 0))
+        store.save('old', 'data')
+        self.age(store, 'old', 120)
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(os.listdir(self.path), ['other'])
+
+
+class TestSQLiteStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = mortimer.session.SQLiteStore(os.path.join(self.path, 'sessions.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def test_save_load(self):
+        self.store.save('abc', 'data\x00\xff')
+        self.assertEqual(self.store.load('abc'), 'data\x00\xff')
+        self.store.save('abc', 'new')
+        self.assertEqual(self.store.load('abc'), 'new')
+        self.store.delete('abc')
+        self.assertRaises(KeyError, self.store.load, 'abc')
+
+    def test_save_many_load_many(self):
+        items = [('s%d' % i, 'data%d' % i) for i in range(1200)]
+        self.store.save_many(items)
+        found = self.store.load_many([session_id for (session_id, data) in items] + ['missing'])
+        self.assertEqual(found, dict(items))
+
+    def test_ttl(self):
+        self.store.ttl = 60
+        self.store.save('new', 'data')
+        self.store.ttl = -1
+        self.store.save('old', 'data')
+        self.assertRaises(KeyError, self.store.load, 'old')
+        self.assertEqual(self.store.load_many(['old', 'new']), {'new': 'data'})
+        self.assertEqual(self.store.sweep(), 1)
+        self.assertEqual(self.store.load('new'), 'data')
+
+    def test_sliding_expiry(self):
+        self.store.ttl = 60
+        self.store.save('abc', 'data')
+        conn = self.store.connection()
+        with conn:
+            conn.execute('UPDATE sessions SET expires = ?', (time.time() + 20,))
+        self.store.load('abc')
+        (expires,) = conn.execute('SELECT expires FROM sessions').fetchone()
+        self.assertTrue(expires > time.time() + 50)
+
+    def test_finished_thread_connections(self):
+        thread = threading.Thread(target=self.store.connection)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(self.store.connections), 2)
+        other = self.store.connections[1][2]
+        thread = threading.Thread(target=self.store.connection)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(self.store.connections), 2)
+        self.assertRaises(mortimer.session.sqlite3.ProgrammingError, other.execute, 'SELECT 1')
+
+    def test_delta(self):
+        serializer = mortimer.session.Session.serializer
+        self.store.save('abc', serializer.dumps({'a': 1, 'b': 2}))
+        first = mortimer.session.Session.load('abc', self.store)
+        second = mortimer.session.Session.load('abc', self.store)
+        first['a'] = 10
+        second['c'] = 3
+        del second['b']
+        first.save(self.store)
+        second.save(self.store)
+        self.assertEqual(serializer.loads(self.store.load('abc')), {'a': 10, 'c': 3})
+
+    def test_connection_per_thread(self):
+        connections = []
+        def load():
+            connections.append(self.store.connection())
+            connections.append(self.store.load('abc'))
+        self.store.save('abc', 'data')
+        thread = threading.Thread(target=load)
+        thread.start()
+        thread.join()
+        self.assertTrue(connections[0] is not self.store.connection())
+        self.assertEqual(connections[1], 'data')
+
+    def test_session(self):
+        session = mortimer.session.Session(session_id='abc')
+        session['user'] = 'someone'
+        session.save(self.store)
+        session = mortimer.session.Session.load('abc', self.store)
+        self.assertTrue(session.loaded)
+        self.assertEqual(session['user'], 'someone')
+
+    def test_cached_store_delete_elsewhere(self):
+        first = mortimer.session.CachedStore(self.store, flush_interval=0, max_age=0.05)
+        second = mortimer.session.CachedStore(self.store, flush_interval=0)
+        session = mortimer.session.Session(session_id='abc')
+        session['user'] = 'alice'
+        session.save(first)
+        self.assertEqual(mortimer.session.Session.load('abc', first)['user'], 'alice')
+        second.delete('abc')
+        time.sleep(0.1)
+        session = mortimer.session.Session.load('abc', first)
+        self.assertEqual(dict(session), {})
+
+    def test_cached_store_flush(self):
+        store = mortimer.session.CachedStore(self.store, flush_interval=60)
+        store.save('a', '1')
+        store.save('b', '2')
+        store.close()
+        self.assertEqual(self.store.load_many(['a', 'b']), {'a': '1', 'b': '2'})
+
+
+class TestSessionId(unittest.TestCase):
+    def test_invalid_session_id(self):
+        path = tempfile.mkdtemp()
+        try:
+            store = mortimer.session.FileStore(path)
+            session = mortimer.session.Session.load('abc.def', store)
+            self.assertNotEqual(session.session_id, 'abc.def')
+            self.assertFalse(session.loaded)
+            session['user'] = 'someone'
+            session.save(store)
+            self.assertEqual(mortimer.session.Session.load(session.session_id, store)['user'], 'someone')
+        finally:
+            shutil.rmtree(path)
+
+    def test_missing_session_id(self):
+        session = mortimer.session.Session.load(None, mortimer.session.DummyStore())
+        self.assertTrue(session.session_id)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import mortimer.web
+from webapplication_test import FakeWSGIRequest
+
+class TestStaticFileHandler(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'file.txt'), 'w') as f:
+            f.write('0123456789')
+        with open(os.path.join(self.root, 'secret'), 'w') as f:
+            f.write('secret')
+        os.mkdir(os.path.join(self.root, 'public'))
+        self.application = mortimer.web.WebApplication()
+        handler = mortimer.web.StaticFileHandler.mount(os.path.join(self.root, 'public'))
+        self.application.router.add_route((r'^/static/(.*)$', handler))
+        with open(os.path.join(self.root, 'public', 'app.js'), 'w') as f:
+            f.write('var x = 1;')
+        f = gzip.open(os.path.join(self.root, 'public', 'app.js.gz'), 'wb')
+        f.write('var x = 1;')
+        f.close()
+        shutil.copy(os.path.join(self.root, 'file.txt'), os.path.join(self.root, 'public'))
+        self.fake_req = FakeWSGIRequest()
+        mortimer.web.StaticFileHandler.stat_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def request(self, path, **headers):
+        self.fake_req.set_path_info(path)
+        self.fake_req.environ.update(headers)
+        body = self.fake_req.run_application(self.application)
+        data = ''.join(body)
+        if hasattr(body, 'close'):
+            body.close()
+        return data
+
+    def header(self, name):
+        return dict(self.fake_req.headers).get(name)
+
+    def test_get(self):
+        self.assertEqual(self.request('/static/file.txt'), '0123456789')
+        self.assertEqual(self.fake_req.status, '200 OK')
+        self.assertEqual(self.header('Content-type'), 'text/plain')
+        self.assertEqual(self.header('Content-Length'), '10')
+
+    def test_missing(self):
+        self.request('/static/missing.txt')
+        self.assertEqual(self.fake_req.status, '404 Not Found')
+
+    def test_outside_root(self):
+        self.request('/static/../secret')
+        self.assertEqual(self.fake_req.status, '404 Not Found')
+        self.request('/static/')
+        self.assertEqual(self.fake_req.status, '404 Not Found')
+
+    def test_etag(self):
+        self.request('/static/file.txt')
+        etag = self.header('ETag')
+        self.assertEqual(self.request('/static/file.txt', HTTP_IF_NONE_MATCH=etag), '')
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+
+    def test_if_modified_since(self):
+        self.request('/static/file.txt')
+        last_modified = self.header('Last-Modified')
+        self.request('/static/file.txt', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+
+    def test_range(self):
+        self.assertEqual(self.request('/static/file.txt', HTTP_RANGE='bytes=2-4'), '234')
+        self.assertEqual(self.fake_req.status, '206 Partial Content')
+        self.assertEqual(self.header('Content-Range'), 'bytes 2-4/10')
+        self.assertEqual(self.request('/static/file.txt', HTTP_RANGE='bytes=-3'), '789')
+
+    def test_unsatisfiable_range(self):
+        self.request('/static/file.txt', HTTP_RANGE='bytes=20-')
+        self.assertEqual(self.fake_req.status, '416 Requested Range Not Satisfiable')
+        self.assertEqual(self.header('Content-Range'), 'bytes */10')
+
+    def test_gzip_sibling(self):
+        data = self.request('/static/app.js', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(self.header('Content-Encoding'), 'gzip')
+        self.assertEqual(self.header('Vary'), 'Accept-Encoding')
+        self.assertEqual(data[:2], '\x1f\x8b')
+        mortimer.web.StaticFileHandler.stat_cache.clear()
+        self.fake_req = FakeWSGIRequest()
+        self.assertEqual(self.request('/static/app.js'), 'var x = 1;')
+        self.assertEqual(self.header('Content-Encoding'), None)
+
+    def test_head(self):
+        self.assertEqual(self.request('/static/file.txt', REQUEST_METHOD='HEAD'), '')
+        self.assertEqual(self.header('Content-Length'), '10')
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+import mortimer.web
+import mortimer.stats
+from webapplication_test import FakeWSGIRequest
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        histogram = mortimer.stats.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.add(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.max, 2.0)
+        self.assertAlmostEqual(histogram.total, 2.65)
+
+    def test_percentile(self):
+        histogram = mortimer.stats.Histogram(buckets=(0.1, 1.0))
+        self.assertEqual(histogram.percentile(50), 0.0)
+        for i in range(98):
+            histogram.add(0.05)
+        histogram.add(0.5)
+        histogram.add(3.0)
+        self.assertEqual(histogram.percentile(50), 0.1)
+        self.assertEqual(histogram.percentile(99), 1.0)
+        self.assertEqual(histogram.percentile(100), 3.0)
+
+
+class TestRequestTimer(unittest.TestCase):
+    def test_nested_phases(self):
+        timer = mortimer.stats.RequestTimer()
+        timer.begin('handler')
+        timer.call('parse', sum, range(100000))
+        timer.end()
+        self.assertTrue(timer.timings['parse'] > 0)
+        self.assertTrue(timer.timings['handler'] >= 0)
+        self.assertEqual(timer.stack, [])
+
+    def test_clock(self):
+        first = mortimer.stats.clock()
+        self.assertTrue(mortimer.stats.clock() >= first)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.fake_req = FakeWSGIRequest()
+        self.stats = mortimer.stats.Stats()
+        self.application = mortimer.web.WebApplication(stats=self.stats)
+
+    def test_disabled(self):
+        class Handler(mortimer.web.RequestHandler):
+            def get(self):
+                return repr(self.timer)
+        application = mortimer.web.WebApplication()
+        application.router.add_route((r'/$', Handler))
+        self.assertEqual(list(self.fake_req.run_application(application)), ['None'])
+
+    def test_phases(self):
+        timers = []
+        class Handler(mortimer.web.RequestHandler):
+            def get(self):
+                self.session['user'] = self.get_args.get('user')
+                timers.append(mortimer.stats.current_timer())
+                return 'Hello'
+        self.application.router.add_route((r'/$', Handler))
+        self.fake_req.environ['QUERY_STRING'] = 'user=someone'
+        self.fake_req.run_application(self.application)
+        snapshot = self.stats.snapshot()
+        self.assertEqual(snapshot.keys(), ['stats_test.Handler'])
+        self.assertEqual(snapshot['stats_test.Handler']['statuses'], {'200': 1})
+        phases = snapshot['stats_test.Handler']['phases']
+        for phase in ('route', 'parse', 'handler', 'session_load', 'session_save', 'other', 'total'):
+            self.assertEqual(phases[phase]['count'], 1)
+        self.assertTrue(phases['total']['total'] >= phases['handler']['total'])
+        self.assertTrue(timers[0] is not None)
+        self.assertEqual(mortimer.stats.current_timer(), None)
+
+    def test_not_found(self):
+        self.fake_req.run_application(self.application)
+        snapshot = self.stats.snapshot()
+        self.assertEqual(snapshot[mortimer.stats.NO_ROUTE]['statuses'], {'404': 1})
+
+    def test_hooks(self):
+        class Handler(mortimer.web.RequestHandler):
+            def get(self):
+                return 'Hello'
+        timers = []
+        self.stats.add_hook(timers.append)
+        self.application.router.add_route((r'/$', Handler))
+        self.fake_req.run_application(self.application)
+        self.assertEqual(len(timers), 1)
+        self.assertEqual(timers[0].route, 'stats_test.Handler')
+        self.assertEqual(timers[0].status, '200 OK')
+
+    def test_stats_handler(self):
+        self.application.router.add_route((r'/_stats$', mortimer.web.StatsHandler))
+        self.fake_req.set_path_info('/_stats')
+        self.fake_req.run_application(self.application)
+        body = ''.join(self.fake_req.run_application(self.application))
+        self.assertEqual(self.fake_req.status, '200 OK')
+        data = json.loads(body)
+        self.assertEqual(data['mortimer.web.StatsHandler']['statuses'], {'200': 1})
+
+    def test_mounted_routes(self):
+        self.application.router.add_route((r'/a/(.*)$', mortimer.web.StaticFileHandler.mount('/srv/a')))
+        self.application.router.add_route((r'/b/(.*)$', mortimer.web.StaticFileHandler.mount('/srv/b')))
+        for path in ('/a/x', '/b/x'):
+            self.fake_req.set_path_info(path)
+            self.fake_req.run_application(self.application)
+        self.assertEqual(len(self.stats.snapshot()), 2)
+
+    def test_stats_handler_disabled(self):
+        application = mortimer.web.WebApplication()
+        application.router.add_route((r'/_stats$', mortimer.web.StatsHandler))
+        self.fake_req.set_path_info('/_stats')
+        self.fake_req.run_application(application)
+        self.assertEqual(self.fake_req.status, '404 Not Found')
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+import subprocess
+import mortimer.util
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = mortimer.util.LRUCache(capacity=2)
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertTrue('a' in self.cache)
+        self.assertFalse('b' in self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_counters(self):
+        self.cache.set('a', None)
+        self.assertEqual(self.cache.get('a', mortimer.util.MISSING), None)
+        self.assertTrue(self.cache.get('b', mortimer.util.MISSING) is mortimer.util.MISSING)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+
+class TestSegmentedLRUCache(unittest.TestCase):
+    def test_scan_resistance(self):
+        cache = mortimer.util.SegmentedLRUCache(capacity=10)
+        for key in ('hot1', 'hot2'):
+            cache.set(key, key)
+            cache.get(key)
+        for i in range(1000):
+            cache.set('scan%d' % i, i)
+        self.assertEqual(cache.get('hot1'), 'hot1')
+        self.assertEqual(cache.get('hot2'), 'hot2')
+        self.assertEqual(len(cache), 10)
+
+    def test_protected_overflow(self):
+        cache = mortimer.util.SegmentedLRUCache(capacity=4, protected_ratio=0.5)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key)
+            cache.get(key)
+        ## 'a' was demoted back to probation rather than dropped
+        self.assertEqual(cache.get('a'), 'a')
+        self.assertEqual(len(cache), 3)
+
+
+MULTIPART_BODY = (
+    '--xyz\r\n'
+    'Content-Disposition: form-data; name="title"\r\n'
+    '\r\n'
+    'hello\r\n'
+    '--xyz\r\n'
+    'Content-Disposition: form-data; name="upload"; filename="a.txt"\r\n'
+    'Content-Type: text/plain\r\n'
+    '\r\n'
+    'line one\r\n--xy line two\r\n'
+    '--xyz--\r\n'
+)
+
+class TestMultipart(unittest.TestCase):
+    def test_parse_multipart(self):
+        post, files = mortimer.util.parse_multipart(MULTIPART_BODY, 'xyz')
+        self.assertEqual(post, {'title': 'hello'})
+        self.assertEqual(files['upload']['filename'], 'a.txt')
+        self.assertEqual(files['upload']['content_type'], 'text/plain')
+        self.assertEqual(files['upload']['file'], 'line one\r\n--xy line two')
+        self.assertEqual(files['upload']['size'], 23)
+
+    def test_chunk_edges(self):
+        parser = mortimer.util.MultipartParser('xyz')
+        for c in MULTIPART_BODY:
+            parser.feed(c)
+        post, files = parser.close()
+        self.assertEqual(post, {'title': 'hello'})
+        self.assertEqual(files['upload']['file'].read(), 'line one\r\n--xy line two')
+
+    def test_spool_to_disk(self):
+        parser = mortimer.util.MultipartParser('xyz', spool_size=4)
+        parser.feed(MULTIPART_BODY)
+        post, files = parser.close()
+        upload = files['upload']['file']
+        self.assertTrue(upload._rolled)
+        self.assertEqual(upload.read(), 'line one\r\n--xy line two')
+
+    def test_field_too_large(self):
+        parser = mortimer.util.MultipartParser('xyz', max_field_size=4)
+        self.assertRaises(mortimer.util.FieldTooLarge, parser.feed, MULTIPART_BODY)
+
+    def test_memory_limit(self):
+        body = (
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="a"; filename="a.txt"\r\n\r\n'
+            'aaaaaa\r\n'
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="b"; filename="b.txt"\r\n\r\n'
+            'bbbbbb\r\n'
+            '--xyz--\r\n'
+        )
+        parser = mortimer.util.MultipartParser('xyz', spool_size=8, max_memory=10)
+        parser.feed(body)
+        post, files = parser.close()
+        self.assertFalse(files['a']['file']._rolled)
+        self.assertTrue(files['b']['file']._rolled)
+        self.assertEqual(files['b']['file'].read(), 'bbbbbb')
+
+    def test_repeated_file_field(self):
+        body = (
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="a"; filename="1.txt"\r\n\r\n'
+            'first\r\n'
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="a"; filename="2.txt"\r\n\r\n'
+            'second\r\n'
+            '--xyz--\r\n'
+        )
+        parser = mortimer.util.MultipartParser('xyz')
+        split = body.index('--xyz', 10) + 7
+        parser.feed(body[:split])
+        first = parser.files['a']['file']
+        parser.feed(body[split:])
+        post, files = parser.close()
+        self.assertTrue(first.closed)
+        self.assertEqual(files['a']['file'].read(), 'second')
+        self.assertEqual(parser.memory, 6)
+
+    def test_truncated_body(self):
+        parser = mortimer.util.MultipartParser('xyz')
+        parser.feed(MULTIPART_BODY[:100])
+        post, files = parser.close()
+        self.assertEqual(post, {'title': 'hello'})
+        self.assertEqual(files, {})
+
+
+class TestFormVars(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(mortimer.util.parse_get_vars(None), {})
+        self.assertEqual(mortimer.util.parse_get_vars(''), {})
+
+    def test_plain(self):
+        data = mortimer.util.parse_get_vars('a=1&b=2')
+        self.assertEqual(data, {'a': '1', 'b': '2'})
+
+    def test_decoding(self):
+        data = mortimer.util.parse_post_vars('a+b=c+d&e=%41%2B%26')
+        self.assertEqual(data, {'a b': 'c d', 'e': 'A+&'})
+
+    def test_value_with_equals(self):
+        data = mortimer.util.parse_get_vars('token=abc==&x=a=b')
+        self.assertEqual(data, {'token': 'abc==', 'x': 'a=b'})
+
+    def test_repeated_keys(self):
+        data = mortimer.util.parse_get_vars('a=1&a=2&a=3&b=4')
+        self.assertEqual(data, {'a': ['1', '2', '3'], 'b': '4'})
+
+    def test_blank_values(self):
+        data = mortimer.util.parse_post_vars('a=&b&&c=1')
+        self.assertEqual(data, {'a': '', 'b': '', 'c': '1'})
+
+
+class TestResponse(unittest.TestCase):
+    def test_code_to_status(self):
+        self.assertEqual(mortimer.util.code_to_status(200), '200 OK')
+        self.assertEqual(mortimer.util.code_to_status(404), '404 Not Found')
+        self.assertEqual(mortimer.util.code_to_status('302 Found'), '302 Found')
+
+    def test_headers_copy_on_write(self):
+        defaults = (('Content-type', 'text/html'),)
+        headers = mortimer.util.Headers(defaults)
+        self.assertEqual(headers.items(), [('Content-type', 'text/html')])
+        headers.add('Content-Type', 'text/plain')
+        headers.add('Location', '/')
+        self.assertEqual(defaults, (('Content-type', 'text/html'),))
+        self.assertEqual(headers.items(), [('Content-Type', 'text/plain'), ('Location', '/')])
+        self.assertEqual(headers.get('content-type'), 'text/plain')
+
+    def test_headers_set_cookie(self):
+        headers = mortimer.util.Headers()
+        headers.add('Set-Cookie', 'a=1')
+        headers.add('Set-Cookie', 'b=2')
+        self.assertEqual(headers.items(), [('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')])
+
+    def test_headers_remove(self):
+        headers = mortimer.util.Headers((('A', '1'), ('B', '2')))
+        headers.remove('a')
+        headers.add('B', '3')
+        self.assertEqual(headers.items(), [('B', '3')])
+        self.assertFalse('A' in headers)
+
+
+class TestHTTPHelpers(unittest.TestCase):
+    def test_http_date(self):
+        date = mortimer.util.http_date(784111777)
+        self.assertEqual(date, 'Sun, 06 Nov 1994 08:49:37 GMT')
+        self.assertEqual(mortimer.util.parse_http_date(date), 784111777)
+        self.assertEqual(mortimer.util.parse_http_date('garbage'), None)
+
+    def test_etag_matches(self):
+        self.assertTrue(mortimer.util.etag_matches('"a", "b"', '"b"'))
+        self.assertTrue(mortimer.util.etag_matches('W/"a"', '"a"'))
+        self.assertTrue(mortimer.util.etag_matches('*', '"a"'))
+        self.assertFalse(mortimer.util.etag_matches('"a"', '"b"'))
+
+    def test_accepts_encoding(self):
+        self.assertTrue(mortimer.util.accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertFalse(mortimer.util.accepts_encoding('gzip;q=0, *', 'gzip'))
+        self.assertTrue(mortimer.util.accepts_encoding('*', 'gzip'))
+        self.assertFalse(mortimer.util.accepts_encoding('identity', 'gzip'))
+
+    def test_parse_byte_range(self):
+        parse = mortimer.util.parse_byte_range
+        self.assertEqual(parse('bytes=0-4', 10), (0, 4))
+        self.assertEqual(parse('bytes=5-', 10), (5, 9))
+        self.assertEqual(parse('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse('bytes=8-20', 10), (8, 9))
+        self.assertEqual(parse('bytes=0-1,4-5', 10), None)
+        self.assertEqual(parse('items=0-1', 10), None)
+        self.assertEqual(parse('bytes=12-', 10), (12, 9))
+
+
+class TestLazyModule(unittest.TestCase):
+    def test_import_on_use(self):
+        module = mortimer.util.LazyModule('colorsys')
+        sys.modules.pop('colorsys', None)
+        self.assertFalse('colorsys' in sys.modules)
+        self.assertEqual(module.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertTrue('colorsys' in sys.modules)
+        self.assertTrue('rgb_to_hsv' in module.__dict__)
+
+    def test_missing_attribute(self):
+        module = mortimer.util.LazyModule('colorsys')
+        self.assertRaises(AttributeError, getattr, module, 'missing')
+
+    def test_web_import(self):
+        ## importing mortimer.web must not pull in the optional subsystems
+        path = os.path.dirname(os.path.dirname(os.path.abspath(mortimer.util.__file__)))
+        env = dict(os.environ, PYTHONPATH=path)
+        code = ('import sys, mortimer.web; '
+                'print sorted(m for m in ("jinja2", "httplib", "mortimer.session") if m in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.strip(), '[]')
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+import mortimer.view
+
+class TestJinja2View(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_path = tempfile.mkdtemp()
+        with open(os.path.join(self.path, 'hello.html'), 'w') as f:
+            f.write('Hello, {{ name }}')
+        with open(os.path.join(self.path, 'list.html'), 'w') as f:
+            f.write('{% for i in items %}{{ i }},{% endfor %}')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        shutil.rmtree(self.cache_path)
+
+    def test_render(self):
+        view = mortimer.view.Jinja2View(self.path)
+        self.assertEqual(view.render('hello.html', name='World'), 'Hello, World')
+        self.assertEqual(view.render('hello.html', name=u'W\xf6rld'), 'Hello, W\xc3\xb6rld')
+
+    def test_preload(self):
+        view = mortimer.view.Jinja2View(self.path, bytecode_cache=self.cache_path,
+                                        auto_reload=False)
+        self.assertEqual(view.preload(), 2)
+        self.assertEqual(sorted(view.templates), ['hello.html', 'list.html'])
+        self.assertTrue(os.listdir(self.cache_path))
+        template = view.get_template('hello.html')
+        self.assertTrue(view.get_template('hello.html') is template)
+
+    def test_render_stream(self):
+        view = mortimer.view.Jinja2View(self.path, stream_buffer=2)
+        chunks = list(view.render_stream('list.html', items=range(5)))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), '0,1,2,3,4,')
+
+    def test_render_stream_missing(self):
+        view = mortimer.view.Jinja2View(self.path)
+        self.assertRaises(IOError, view.render_stream, 'missing.html')
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import unittest
+import StringIO
 import wsgiref.util
 import mortimer.web
+import mortimer.util
+import mortimer.session
 
 class FakeWSGIRequest(object):
     def __init__(self):
@@ -14,6 +17,12 @@ class FakeWSGIRequest(object):
     def set_path_info(self, req_path):
         self.environ['PATH_INFO'] = req_path
 
+    def set_body(self, data, content_type='application/x-www-form-urlencoded'):
+        self.environ['REQUEST_METHOD'] = 'POST'
+        self.environ['CONTENT_TYPE'] = content_type
+        self.environ['CONTENT_LENGTH'] = str(len(data))
+        self.environ['wsgi.input'] = StringIO.StringIO(data)
+
     def start_request(self, status, headers):
         self.status = status
         self.headers = headers
@@ -22,6 +31,20 @@ class FakeWSGIRequest(object):
         return app(self.environ, self.start_request)
 
 
+class MemoryStore(mortimer.session.BaseStore):
+    def __init__(self):
+        self.sessions = {}
+
+    def save(self, session_id, data):
+        self.sessions[session_id] = mortimer.session.Session.serializer.loads(data)
+
+    def load(self, session_id):
+        return mortimer.session.Session.serializer.dumps(self.sessions[session_id])
+
+    def delete(self, session_id):
+        self.sessions.pop(session_id, None)
+
+
 class TestWebApplication(unittest.TestCase):
     def setUp(self):
         self.fake_req = FakeWSGIRequest()
@@ -34,4 +57,416 @@ class TestWebApplication(unittest.TestCase):
         application.router.add_route((r'/$', HelloWorldController))
         iterator = self.fake_req.run_application(application)
         self.assertEqual(self.fake_req.status, '200 OK')
-        self.assertEqual(iterator.next(), 'Hello, World')
\ No newline at end of file
+        self.assertEqual(iterator.next(), 'Hello, World')
+
+    def test_route_cache(self):
+        class HelloWorldController(mortimer.web.RequestHandler):
+            def get(self):
+                return 'Hello, World'
+        application = mortimer.web.WebApplication(route_cache_size=10)
+        application.router.add_route((r'/$', HelloWorldController))
+        self.fake_req.run_application(application)
+        self.fake_req.run_application(application)
+        self.assertEqual(application.route_cache.hits, 1)
+        self.assertEqual(application.route_cache.misses, 1)
+
+    def test_route_cache_invalidation(self):
+        class HelloWorldController(mortimer.web.RequestHandler):
+            def get(self):
+                return 'Hello, World'
+        application = mortimer.web.WebApplication(route_cache_size=10)
+        self.assertRaises(mortimer.web.HTTPError, application.find_route, '/')
+        self.assertRaises(mortimer.web.HTTPError, application.find_route, '/')
+        application.router.add_route((r'/$', HelloWorldController))
+        self.assertEqual(application.find_route('/'), (HelloWorldController, ()))
+
+
+class UnreadableInput(object):
+    def read(self, size=-1):
+        raise AssertionError('wsgi.input should not be read')
+
+
+class TestRequestBody(unittest.TestCase):
+    def setUp(self):
+        self.fake_req = FakeWSGIRequest()
+
+    def run_handler(self, handler, application=None):
+        if application is None:
+            application = mortimer.web.WebApplication()
+        application.router.add_route((r'/$', handler))
+        return list(self.fake_req.run_application(application))
+
+    def test_body_not_read(self):
+        class Controller(mortimer.web.RequestHandler):
+            def post(self):
+                return 'ignored'
+        self.fake_req.set_body('a=1')
+        self.fake_req.environ['wsgi.input'] = UnreadableInput()
+        self.assertEqual(self.run_handler(Controller), ['ignored'])
+
+    def test_post_args(self):
+        class Controller(mortimer.web.RequestHandler):
+            def post(self):
+                return self.post_args['a'] + self.body
+        self.fake_req.set_body('a=1')
+        self.assertEqual(self.run_handler(Controller), ['1a=1'])
+
+    def test_stream(self):
+        class Controller(mortimer.web.RequestHandler):
+            body_chunk_size = 4
+            def post(self):
+                return '|'.join(self.stream)
+        self.fake_req.set_body('0123456789')
+        self.fake_req.environ['CONTENT_LENGTH'] = '9'
+        self.assertEqual(self.run_handler(Controller), ['0123|4567|8'])
+
+    def test_max_body_size(self):
+        class Controller(mortimer.web.RequestHandler):
+            def post(self):
+                return self.body
+        self.fake_req.set_body('0123456789')
+        self.fake_req.environ['wsgi.input'] = UnreadableInput()
+        application = mortimer.web.WebApplication(max_body_size=5)
+        self.run_handler(Controller, application)
+        self.assertEqual(self.fake_req.status, '413 Request Entity Too Large')
+
+    def test_multipart_files(self):
+        class Controller(mortimer.web.RequestHandler):
+            def post(self):
+                upload = self.files['upload']
+                return self.post_args['title'] + ':' + upload['file'].read()
+        body = (
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="title"\r\n\r\n'
+            'hello\r\n'
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="upload"; filename="a.txt"\r\n\r\n'
+            'contents\r\n'
+            '--xyz--\r\n'
+        )
+        self.fake_req.set_body(body, 'multipart/form-data; boundary=xyz')
+        self.assertEqual(self.run_handler(Controller), ['hello:contents'])
+
+    def test_multipart_field_too_large(self):
+        class Controller(mortimer.web.RequestHandler):
+            max_field_size = 4
+            def post(self):
+                return self.post_args['title']
+        body = (
+            '--xyz\r\n'
+            'Content-Disposition: form-data; name="title"\r\n\r\n'
+            'hello\r\n'
+            '--xyz--\r\n'
+        )
+        self.fake_req.set_body(body, 'multipart/form-data; boundary=xyz')
+        self.run_handler(Controller)
+        self.assertEqual(self.fake_req.status, '413 Request Entity Too Large')
+
+    def test_parsed_once(self):
+        class Controller(mortimer.web.RequestHandler):
+            def post(self):
+                assert self.post_args is self.post_args
+                assert self.get_args is self.get_args
+                assert self.cookies is self.cookies
+                return self.post_args['a'] + self.get_args['b'] + self.cookies['c']
+        self.fake_req.set_body('a=1')
+        self.fake_req.environ['QUERY_STRING'] = 'b=2'
+        self.fake_req.environ['HTTP_COOKIE'] = 'c=3'
+        self.assertEqual(self.run_handler(Controller), ['123'])
+
+    def test_headers(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                self.set_cookie('a=1')
+                self.set_cookie('b=2')
+                self.set_content_type('text/plain')
+                return self.redirect('/login')
+        self.fake_req.environ['REQUEST_METHOD'] = 'GET'
+        self.run_handler(Controller)
+        self.assertEqual(self.fake_req.status, '302 Found')
+        self.assertEqual(self.fake_req.headers, [
+            ('Content-type', 'text/plain'),
+            ('Set-Cookie', 'a=1; path=/'),
+            ('Set-Cookie', 'b=2; path=/'),
+            ('Location', '/login'),
+        ])
+
+
+class ClosingFile(StringIO.StringIO):
+    closed_by_server = False
+
+    def close(self):
+        ClosingFile.closed_by_server = True
+        StringIO.StringIO.close(self)
+
+
+class TestResponseBody(unittest.TestCase):
+    def setUp(self):
+        self.fake_req = FakeWSGIRequest()
+
+    def run_handler(self, handler):
+        application = mortimer.web.WebApplication()
+        application.router.add_route((r'/$', handler))
+        return self.fake_req.run_application(application)
+
+    def test_generator(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                for i in range(3):
+                    yield 'row %d\n' % i
+        body = self.run_handler(Controller)
+        self.assertEqual(list(body), ['row 0\n', 'row 1\n', 'row 2\n'])
+        self.assertEqual(self.fake_req.status, '200 OK')
+
+    def run_session_handler(self, handler):
+        application = mortimer.web.WebApplication()
+        application.session_store = MemoryStore()
+        application.router.add_route((r'/$', handler))
+        return (application.session_store, self.fake_req.run_application(application))
+
+    def test_generator_session(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                session = self.session
+                yield 'row\n'
+                session['user'] = 'bob'
+        self.fake_req.environ['HTTP_COOKIE'] = 'session_id=abc'
+        (store, body) = self.run_session_handler(Controller)
+        self.assertEqual(store.sessions, {})
+        self.assertEqual(list(body), ['row\n'])
+        self.assertEqual(store.sessions['abc']['user'], 'bob')
+
+    def test_streaming_session_cookie(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                self.session['user'] = 'bob'
+                return iter(['row\n'])
+        (store, body) = self.run_session_handler(Controller)
+        self.assertTrue('Set-Cookie' in dict(self.fake_req.headers))
+        self.assertEqual(store.sessions, {})
+        self.assertEqual(list(body), ['row\n'])
+        self.assertEqual(store.sessions.values()[0]['user'], 'bob')
+
+    def test_generator_session_closed(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                self.session['user'] = 'bob'
+                yield 'row\n'
+                yield 'row\n'
+        (store, body) = self.run_session_handler(Controller)
+        body.next()
+        body.close()
+        self.assertEqual(len(store.sessions), 1)
+
+    def test_generator_error(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                self.session['user'] = 'bob'
+                yield 'row\n'
+                raise ValueError('broken')
+        self.fake_req.environ['wsgi.errors'] = StringIO.StringIO()
+        (store, body) = self.run_session_handler(Controller)
+        self.assertEqual(list(body), ['row\n'])
+        self.assertEqual(store.sessions, {})
+        self.assertTrue('ValueError' in self.fake_req.environ['wsgi.errors'].getvalue())
+
+    def test_file(self):
+        class Controller(mortimer.web.RequestHandler):
+            file_block_size = 4
+            def get(self):
+                return ClosingFile('0123456789')
+        ClosingFile.closed_by_server = False
+        body = self.run_handler(Controller)
+        self.assertEqual(list(body), ['0123', '4567', '89'])
+        body.close()
+        self.assertTrue(ClosingFile.closed_by_server)
+
+    def test_file_wrapper(self):
+        class FileWrapper(object):
+            def __init__(self, f, block_size):
+                self.f = f
+                self.block_size = block_size
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                return ClosingFile('data')
+        self.fake_req.environ['wsgi.file_wrapper'] = FileWrapper
+        body = self.run_handler(Controller)
+        self.assertTrue(isinstance(body, FileWrapper))
+        self.assertEqual(body.block_size, 65536)
+
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        self.fake_req = FakeWSGIRequest()
+        self.calls = []
+
+    def run_handler(self, handler, **env):
+        application = mortimer.web.WebApplication()
+        application.router.add_route((r'/$', handler))
+        self.fake_req.environ.update(env)
+        return list(self.fake_req.run_application(application))
+
+    def test_auto_etag(self):
+        class Controller(mortimer.web.RequestHandler):
+            auto_etag = True
+            def get(self):
+                return 'Hello, World'
+        self.assertEqual(self.run_handler(Controller), ['Hello, World'])
+        etag = dict(self.fake_req.headers)['ETag']
+        self.assertEqual(self.run_handler(Controller, HTTP_IF_NONE_MATCH=etag), [])
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+        self.assertEqual(self.run_handler(Controller, HTTP_IF_NONE_MATCH='"other"'), ['Hello, World'])
+
+    def test_validators_skip_handler(self):
+        calls = self.calls
+        class Controller(mortimer.web.RequestHandler):
+            def validators(self):
+                return ('"v1"', None)
+            def get(self):
+                calls.append(1)
+                return 'expensive'
+        self.assertEqual(self.run_handler(Controller, HTTP_IF_NONE_MATCH='"v1"'), [])
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+        self.assertEqual(calls, [])
+
+    def test_if_modified_since(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                self.set_last_modified(1000000)
+                return 'content'
+        since = mortimer.util.http_date(1000000)
+        self.assertEqual(self.run_handler(Controller, HTTP_IF_MODIFIED_SINCE=since), [])
+        self.assertEqual(self.fake_req.status, '304 Not Modified')
+        since = mortimer.util.http_date(999999)
+        self.assertEqual(self.run_handler(Controller, HTTP_IF_MODIFIED_SINCE=since), ['content'])
+
+
+class TestMethodDispatch(unittest.TestCase):
+    def setUp(self):
+        self.fake_req = FakeWSGIRequest()
+        self.fake_req.environ['wsgi.errors'] = StringIO.StringIO()
+
+    def run_handler(self, handler, method='GET'):
+        application = mortimer.web.WebApplication()
+        application.router.add_route((r'/$', handler))
+        self.fake_req.environ['REQUEST_METHOD'] = method
+        return list(self.fake_req.run_application(application))
+
+    def test_dispatch_table(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                return 'get'
+            def post(self):
+                return 'post'
+        class SubController(Controller):
+            def delete(self):
+                return 'delete'
+        (methods, allow) = Controller.dispatch_table()
+        self.assertEqual(allow, 'GET, HEAD, POST, OPTIONS')
+        self.assertTrue(Controller.dispatch_table()[0] is Controller.dispatch_table()[0])
+        self.assertEqual(SubController.find_method('DELETE'), 'delete')
+        self.assertEqual(Controller.find_method('DELETE'), None)
+
+    def test_not_found(self):
+        application = mortimer.web.WebApplication()
+        self.assertEqual(application.lookup_route('/'), None)
+        self.assertEqual(list(self.fake_req.run_application(application)), ['404 Not Found'])
+        self.assertEqual(self.fake_req.status, '404 Not Found')
+        self.assertEqual(self.fake_req.environ['wsgi.errors'].getvalue(), '')
+
+    def test_method_not_allowed(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                return 'get'
+        self.run_handler(Controller, method='POST')
+        self.assertEqual(self.fake_req.status, '405 Method Not Allowed')
+        self.assertEqual(dict(self.fake_req.headers)['Allow'], 'GET, HEAD, OPTIONS')
+        self.assertEqual(self.fake_req.environ['wsgi.errors'].getvalue(), '')
+
+    def test_head(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                return 'Hello, World'
+        self.assertEqual(self.run_handler(Controller, method='HEAD'), [])
+        self.assertEqual(self.fake_req.status, '200 OK')
+        self.assertEqual(dict(self.fake_req.headers)['Content-Length'], '12')
+
+    def test_options(self):
+        class Controller(mortimer.web.RequestHandler):
+            def post(self):
+                return 'post'
+        self.assertEqual(self.run_handler(Controller, method='OPTIONS'), [''])
+        self.assertEqual(self.fake_req.status, '200 OK')
+        self.assertEqual(dict(self.fake_req.headers)['Allow'], 'POST, OPTIONS')
+
+    def test_custom_method(self):
+        class Controller(mortimer.web.RequestHandler):
+            http_methods = mortimer.web.RequestHandler.http_methods + ('PROPFIND',)
+            def propfind(self):
+                return 'propfind'
+            def redirect_home(self):
+                return 'no'
+        self.assertEqual(self.run_handler(Controller, method='PROPFIND'), ['propfind'])
+        self.run_handler(Controller, method='REDIRECT_HOME')
+        self.assertEqual(self.fake_req.status, '405 Method Not Allowed')
+        self.assertEqual(dict(self.fake_req.headers)['Allow'], 'OPTIONS, PROPFIND')
+
+    def test_attribute_error(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                return self.missing
+        self.run_handler(Controller)
+        self.assertEqual(self.fake_req.status, '500 Internal Server Error')
+        self.assertTrue('AttributeError' in self.fake_req.environ['wsgi.errors'].getvalue())
+
+
+class TestLightweightHandler(unittest.TestCase):
+    def setUp(self):
+        self.fake_req = FakeWSGIRequest()
+        self.application = mortimer.web.WebApplication()
+
+    def test_slots(self):
+        class Controller(mortimer.web.RequestHandler):
+            __slots__ = ()
+        handler = Controller(self.application, self.fake_req.environ)
+        self.assertFalse(hasattr(handler, '__dict__'))
+
+    def test_subclass_attributes(self):
+        class Controller(mortimer.web.RequestHandler):
+            def init_request(self):
+                self.user = 'someone'
+        handler = Controller(self.application, self.fake_req.environ)
+        self.assertEqual(handler.user, 'someone')
+
+    def test_lazy_headers(self):
+        handler = mortimer.web.RequestHandler(self.application, self.fake_req.environ)
+        self.assertEqual(handler.response_headers(), list(mortimer.web.DEFAULT_HEADERS))
+        self.assertEqual(handler._headers, None)
+        handler.add_header('X-Test', '1')
+        self.assertEqual(handler.response_headers()[-1], ('X-Test', '1'))
+
+    def test_assign_headers_list(self):
+        handler = mortimer.web.RequestHandler(self.application, self.fake_req.environ)
+        handler.headers = [('Content-type', 'application/json')]
+        handler.add_header('X-Test', '1')
+        self.assertEqual(handler.response_headers(),
+                         [('Content-type', 'application/json'), ('X-Test', '1')])
+
+    def test_session_store(self):
+        handler = mortimer.web.RequestHandler(self.application, self.fake_req.environ)
+        self.assertEqual(handler.session_store, None)
+        self.assertEqual(handler.session, {})
+        self.assertTrue(isinstance(handler.session_store, mortimer.session.DummyStore))
+        store = mortimer.session.DummyStore()
+        self.application.session_store = store
+        handler = mortimer.web.RequestHandler(self.application, self.fake_req.environ)
+        self.assertTrue(handler.session_store is store)
+
+    def test_http_error(self):
+        class Controller(mortimer.web.RequestHandler):
+            def get(self):
+                raise mortimer.web.HTTPError(status=403)
+        self.application.router.add_route((r'/$', Controller))
+        self.assertEqual(list(self.fake_req.run_application(self.application)), ['403 Forbidden'])
+        self.assertEqual(self.fake_req.status, '403 Forbidden')
+        self.assertEqual(dict(self.fake_req.headers)['Content-type'], 'text/plain')